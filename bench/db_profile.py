@@ -0,0 +1,99 @@
+#! /usr/bin/env python
+# -*- mode: python; coding: utf-8 -*-
+# Copyright 2015 Peter Williams <peter@newton.cx>
+# Licensed under the GNU General Public License, version 3 or higher.
+
+"""Compare ingest and listing speed with SQLite's stock settings against the
+[db] profile in defaults.cfg. Usage:
+
+  python bench/db_profile.py [npubs]
+
+Each profile gets a scratch database in a temporary directory.
+
+"""
+
+from __future__ import absolute_import, division, print_function, unicode_literals
+import os.path, random, shutil, sys, tempfile, time
+
+from bibtools.config import RCP
+from bibtools.db import connect
+from bibtools.util import datastream
+
+
+def make_infos (n, seed=0):
+    rng = random.Random (seed)
+    surnames = ['Smith', 'Jones', 'Williams', 'Berger', 'Garcia', 'Chen',
+                'Kumar', 'Nakamura', 'Brown', 'van_der_Berg']
+    words = ('magnetic flare dwarf radio emission star planet galaxy '
+             'survey observations spectra cluster').split ()
+
+    for i in xrange (n):
+        authors = ['%s. %s%d' % (chr (65 + rng.randrange (26)),
+                                 rng.choice (surnames), rng.randrange (n // 4 + 1))
+                   for _ in xrange (rng.randint (1, 8))]
+        yield dict (abstract=' '.join (rng.choice (words) for _ in xrange (150)),
+                    authors=authors,
+                    doi='10.1000/bench.%d' % i,
+                    nicknames=['bench%d' % i],
+                    refdata={'_type': 'article', 'journal': 'ApJ',
+                             'volume': unicode (rng.randrange (900))},
+                    title=' '.join (rng.choice (words) for _ in xrange (8)),
+                    year=rng.randint (1980, 2015))
+
+
+def make_cfg (tuned):
+    cfg = RCP ()
+    if tuned:
+        cfg.readfp (datastream ('defaults.cfg'))
+    return cfg
+
+
+def timed (func):
+    t0 = time.time ()
+    func ()
+    return time.time () - t0
+
+
+def run_profile (tuned, npubs):
+    workdir = tempfile.mkdtemp (prefix='bibbench.')
+
+    try:
+        path = os.path.join (workdir, 'db.sqlite3')
+        db = connect (make_cfg (tuned), path, create=True)
+        results = []
+
+        db.learn_batch_size = 500
+        results.append (timed (lambda: db.learn_pubs (make_infos (npubs))))
+
+        # Lots of little transactions, like repeated autolearns or edits.
+        def one_at_a_time ():
+            for info in make_infos (200, seed=1):
+                info['nicknames'] = ['single' + info['nicknames'][0]]
+                db.learn_pub (info)
+                db.commit ()
+        results.append (timed (one_at_a_time))
+
+        def listing ():
+            ids = [t[0] for t in db.execute ('SELECT id, nfas, year, title FROM pubs '
+                                             'ORDER BY nfas, year')]
+            db.get_authors_for_pubs (ids)
+        results.append (timed (listing))
+
+        db.close ()
+        return results
+    finally:
+        shutil.rmtree (workdir)
+
+
+def main (argv):
+    npubs = int (argv[1]) if len (argv) > 1 else 20000
+    print ('%d pubs' % npubs)
+    print ('%-8s %12s %16s %12s' % ('profile', 'bulk ingest', '200 single txns', 'listing'))
+
+    for name, tuned in (('stock', False), ('tuned', True)):
+        bulk, single, listing = run_profile (tuned, npubs)
+        print ('%-8s %11.2fs %15.2fs %11.2fs' % (name, bulk, single, listing))
+
+
+if __name__ == '__main__':
+    main (sys.argv)
@@ -0,0 +1,83 @@
+#! /usr/bin/env python
+# -*- mode: python; coding: utf-8 -*-
+# Copyright 2015 Peter Williams <peter@newton.cx>
+# Licensed under the GNU General Public License, version 3 or higher.
+
+"""Time sniff_url() on a sample of real-world URLs as the number of registered
+URL patterns grows. Usage:
+
+  python bench/url_sniff.py [nrounds]
+
+The "cold" column clears the memoization cache before every lookup; "warm"
+doesn't.
+
+"""
+
+from __future__ import absolute_import, division, print_function, unicode_literals
+import sys, time
+
+from bibtools import bibcore
+
+
+corpus = [
+    'http://dx.doi.org/10.1086/345256',
+    'https://doi.org/10.3847/1538-4357/aa8b76',
+    'https://doi.org/10.1093/mnras/stx2120',
+    'http://adsabs.harvard.edu/abs/2010ApJ...710.1345W',
+    'http://adsabs.harvard.edu/cgi-bin/nph-bib_query?bibcode=2005ApJ...627..960W',
+    'https://ui.adsabs.harvard.edu/abs/2017ApJ...846..106W/abstract',
+    'https://ui.adsabs.harvard.edu/#abs/2015A%26A...577A..10B/abstract',
+    'http://labs.adsabs.harvard.edu/adsabs/abs/2014ApJ...785....9W/',
+    'http://labs.adsabs.harvard.edu/ui/abs/2013ApJ...767...30W',
+    'http://arxiv.org/abs/1501.01234',
+    'https://arxiv.org/abs/1707.04264v2',
+    'https://arxiv.org/pdf/1707.04264v2.pdf',
+    'http://arxiv.org/abs/astro-ph/0601001v1',
+    'https://export.arxiv.org/abs/1602.03837',
+    'https://www.nature.com/articles/nature22040',
+    'http://iopscience.iop.org/article/10.3847/1538-4357/aa8b76/meta',
+    'https://academic.oup.com/mnras/article/471/2/1234/3916475',
+    'http://www.aanda.org/articles/aa/abs/2015/05/aa25404-14/aa25404-14.html',
+]
+
+
+def add_patterns (start, stop):
+    # Plausible-looking patterns that share prefixes with the real ones.
+    hosts = ['journals.example.org', 'ui.adsabs.harvard.edu', 'arxiv.org',
+             'doi.org', 'www.publisher%d.com']
+
+    for i in xrange (start, stop):
+        host = hosts[i % len (hosts)]
+        if '%' in host:
+            host = host % i
+        bibcore.register_url_pattern ('https://%s/path%d/' % (host, i), 'doi')
+
+
+def per_lookup (nrounds, cold):
+    t0 = time.time ()
+
+    for _ in xrange (nrounds):
+        for url in corpus:
+            if cold:
+                bibcore._url_cache.clear ()
+            bibcore.sniff_url (url)
+
+    return (time.time () - t0) / (nrounds * len (corpus))
+
+
+def main (argv):
+    nrounds = int (argv[1]) if len (argv) > 1 else 2000
+    total = 0
+
+    print ('%9s %12s %12s' % ('patterns', 'cold', 'warm'))
+
+    for extra in (0, 100, 1000, 10000):
+        add_patterns (total, extra)
+        total = extra
+        npat = len (bibcore._url_patterns) + total
+        print ('%9d %10.2fus %10.2fus' % (npat, 1e6 * per_lookup (nrounds, True),
+                                          1e6 * per_lookup (nrounds, False)))
+
+
+if __name__ == '__main__':
+    main (sys.argv)
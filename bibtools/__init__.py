@@ -8,7 +8,7 @@ Global structure for the bibliography tool.
 
 from __future__ import absolute_import, division, print_function, unicode_literals
 
-__all__ = ('BibApp BibError PubLocateError MultiplePubsError').split ()
+__all__ = ('AutolearnError BibApp BibError PubLocateError MultiplePubsError').split ()
 
 
 class BibError (Exception):
@@ -31,6 +31,11 @@ class PubLocateError (BibError):
 class MultiplePubsError (PubLocateError):
     pass
 
+class AutolearnError (PubLocateError):
+    """The web services definitely don't know about a publication, as opposed
+    to just being unreachable. These failures go in the negative cache."""
+    pass
+
 
 class BibApp (object):
     _thedb = None
@@ -41,7 +46,7 @@ class BibApp (object):
     def db (self):
         if self._thedb is None:
             from .db import connect
-            self._thedb = connect ()
+            self._thedb = connect (self.cfg)
         return self._thedb
 
 
@@ -49,7 +54,9 @@ class BibApp (object):
     def cfg (self):
         if self._thecfg is None:
             from .config import BibConfig
+            from .bibcore import load_url_patterns
             self._thecfg = BibConfig ()
+            load_url_patterns (self._thecfg)
         return self._thecfg
 
 
@@ -73,63 +80,139 @@ class BibApp (object):
 
     # Global-level helpers
 
-    def locate_pubs (self, textids, noneok=False, autolearn=False):
+    def parse_pub_ref (self, textid):
+        """Returns (kind, key, year) describing the pubs that `textid` refers
+        to. For "lastlisting" refs the key is the index into the listing; for
+        "nfasy" and "author" refs it is the surname, and the year may be
+        None. Otherwise the year is None."""
         from .bibcore import classify_pub_ref
 
-        for textid in textids:
-            kind, text = classify_pub_ref (textid)
-            q = matchtext = None
-
-            if kind == 'doi':
-                q = self.db.pub_query ('doi = ?', text)
-                matchtext = 'DOI = ' + text
-            elif kind == 'bibcode':
-                q = self.db.pub_query ('bibcode = ?', text)
-                matchtext = 'bibcode = ' + text
-            elif kind == 'arxiv':
-                q = self.db.pub_query ('arxiv = ?', text)
-                matchtext = 'arxiv = ' + text
-            elif kind == 'nickname':
-                q = self.db.pub_fquery ('SELECT p.* FROM pubs AS p, nicknames AS n '
-                                  'WHERE p.id == n.pubid AND n.nickname = ?', text)
-                matchtext = 'nickname = ' + text
-            elif kind == 'lastlisting':
+        kind, text = classify_pub_ref (textid)
+
+        if kind == 'lastlisting':
+            try:
+                idx = int (text) - 1
+                assert idx >= 0
+            except:
+                raise PubLocateError ('pub names starting with %% should be '
+                                      'followed by positive numbers, but got '
+                                      '"%s"', text)
+            return kind, idx, None
+
+        if kind in ('nfasy', 'author'):
+            surname, year = text.rsplit ('.', 1)
+            if year == '*':
+                return kind, surname, None
+            return kind, surname, int (year)
+
+        return kind, text, None
+
+
+    def pub_ref_query (self, textid, columns='p.*'):
+        """Returns (sql, args) for a query finding the pubs that `textid`
+        refers to. `columns` is the list of columns to select from the pubs
+        table, which is aliased as "p"."""
+
+        kind, key, year = self.parse_pub_ref (textid)
+        select = 'SELECT ' + columns + ' FROM pubs AS p '
+
+        if kind == 'doi':
+            q = select + 'WHERE p.doi = ?'
+        elif kind == 'bibcode':
+            q = select + 'WHERE p.bibcode = ?'
+        elif kind == 'arxiv':
+            q = select + 'WHERE p.arxiv = ?'
+        elif kind == 'nickname':
+            q = select + ', nicknames AS n WHERE p.id == n.pubid AND n.nickname = ?'
+        elif kind == 'lastlisting':
+            q = (select + ', publists AS l WHERE p.id == l.pubid AND '
+                 "l.name = 'last_listing' AND l.idx = ?")
+        elif kind == 'nfasy':
+            q = select + 'WHERE p.nfas = ?'
+        elif kind == 'author':
+            q = (select + 'WHERE p.id IN (SELECT a.pubid FROM author_names AS n, '
+                 'authors AS a WHERE n.surname == ? AND a.authid == n.oid)')
+        else:
+            # This is a bug since we should handle every possible 'kind'
+            # returned by classify_pub_ref.
+            assert False
+
+        if year is None:
+            return q, (key, )
+        return q + ' AND p.year = ?', (key, year)
+
+
+    def locate_pubs (self, textids, noneok=False, autolearn=False, columns='p.*'):
+        """Yields the PubRows matching each of `textids`, in order. `columns` is
+        as in pub_ref_query(), but must include the id; listings should pass
+        `self.db.listing_columns`. Autolearned pubs always come back as
+        complete rows.
+
+        Many identifiers are resolved in a batch, with one query for each kind
+        of identifier, and any that need to be autolearned are looked up on
+        the web in parallel. Errors are still raised when the generator
+        reaches the identifier in question."""
+
+        textids = list (textids)
+        pool = None
+
+        if len (textids) < 2:
+            refs = errors = None
+        else:
+            refs = []
+            errors = {}
+
+            for i, textid in enumerate (textids):
                 try:
-                    idx = int (text) - 1
-                    assert idx >= 0
-                except:
-                    raise PubLocateError ('pub names starting with %% should be '
-                                          'followed by positive numbers, but got '
-                                          '"%s"', text)
-                q = self.db.pub_fquery ('SELECT p.* FROM pubs AS p, publists AS l '
-                                        'WHERE p.id == l.pubid AND l.name = ? AND '
-                                        'l.idx = ?', 'last_listing', idx)
-                matchtext = 'lastlisting #' + text
-            elif kind == 'nfasy':
-                nfas, year = text.rsplit ('.', 1)
-                if year == '*':
-                    q = self.db.pub_query ('nfas = ?', nfas)
+                    refs.append (self.parse_pub_ref (textid))
+                except PubLocateError as e:
+                    refs.append (None)
+                    errors[i] = e
+
+            matches = self.db.resolve_pub_refs (refs)
+            pubs = self.db.get_pubs_by_ids (set (pubid for m in matches for pubid in m),
+                                            columns)
+
+            if autolearn:
+                # Start looking up the ones that we're going to need to learn,
+                # up to the first that we couldn't parse, where we'll stop.
+                from .bibcore import AutolearnPool
+                stop = min (errors) if len (errors) else len (textids)
+                pool = AutolearnPool (self, (textid for i, textid in enumerate (textids[:stop])
+                                             if not len (matches[i])))
+
+        try:
+            for i, textid in enumerate (textids):
+                if refs is None:
+                    sql, qargs = self.pub_ref_query (textid, columns)
+                    found = list (self.db.pub_fquery (sql, *qargs))
+                elif i in errors:
+                    raise errors[i]
                 else:
-                    q = self.db.pub_query ('nfas = ? AND year = ?', nfas, year)
-                matchtext = 'surname/year ~ ' + text
-            else:
-                # This is a bug since we should handle every possible 'kind'
-                # returned by classify_pub_ref.
-                assert False
+                    found = [pubs[pubid] for pubid in matches[i]]
 
-            gotany = False
+                if not len (found) and autolearn and refs is not None:
+                    # It might have been learned for an earlier duplicate.
+                    sql, qargs = self.pub_ref_query (textid, columns)
+                    found = list (self.db.pub_fquery (sql, *qargs))
 
-            for pub in q:
-                gotany = True
-                yield pub
+                for pub in found:
+                    yield pub
 
-            if not gotany and autolearn:
-                from .bibcore import autolearn_pub
-                yield self.db.learn_pub (autolearn_pub (self, textid))
-                continue
+                if not len (found) and autolearn:
+                    if pool is not None:
+                        info = pool.get (textid)
+                    else:
+                        from .bibcore import autolearn_pub
+                        info = autolearn_pub (self, textid)
+                    yield self.db.learn_pub (info)
+                    continue
 
-            if not gotany and not noneok:
-                raise PubLocateError ('no publications matched ' + textid)
+                if not len (found) and not noneok:
+                    raise PubLocateError ('no publications matched ' + textid)
+        finally:
+            if pool is not None:
+                pool.close ()
 
 
     def locate_pub (self, text, noneok=False, autolearn=False):
@@ -165,10 +248,18 @@ class BibApp (object):
             print ('error:', e, file=sys.stderr)
             print (file=sys.stderr)
             from .bibcore import print_generic_listing
-            print_generic_listing (self.db, self.locate_pubs ((text,), noneok=True), stream=sys.stderr)
+            print_generic_listing (self.db,
+                                   self.locate_pubs ((text,), noneok=True,
+                                                     columns=self.db.listing_columns),
+                                   stream=sys.stderr)
             raise SystemExit (1)
         except PubLocateError as e:
             from .util import die
+            from .fuzzy import suggest_pub_refs
+
+            suggestions = suggest_pub_refs (self.db, text)
+            if len (suggestions):
+                die ('%s; did you mean %s?', e, ' or '.join (suggestions))
             die (e)
 
 
@@ -200,14 +291,23 @@ class BibApp (object):
     def export_all (self, stream, width):
         from .textfmt import export_one
         first = True
+        q = self.db.pub_fquery ('SELECT * FROM pubs ORDER BY nfas ASC, year ASC')
 
-        for pub in self.db.pub_fquery ('SELECT * FROM pubs ORDER BY nfas ASC, year ASC'):
-            if first:
-                first = False
-            else:
-                stream.write ('\f\n')
+        while True:
+            # Fetch the author lists in bulk, a chunk of pubs at a time.
+            chunk = q.fetchmany (512)
+            if not len (chunk):
+                break
+
+            authors = self.db.get_authors_for_pubs (p.id for p in chunk)
+
+            for pub in chunk:
+                if first:
+                    first = False
+                else:
+                    stream.write ('\f\n')
 
-            export_one (self, pub, stream, width)
+                export_one (self, pub, stream, width, authors[pub.id])
 
 
     def rsync_backup (self):
@@ -9,6 +9,7 @@ Tools relating to working with NASA's ADS.
 from __future__ import absolute_import, division, print_function, unicode_literals
 import json
 
+from . import AutolearnError, PubLocateError
 from .util import *
 from . import webutil as wu
 from .bibcore import *
@@ -61,7 +62,7 @@ def autolearn_bibcode (app, bibcode):
 
     print ('[Parsing', url, '...]')
 
-    for line in wu.urlopen (url):
+    for line in wu.fetch_url (url).splitlines ():
         line = line.decode ('iso-8859-1').strip ()
 
         if not len (line):
@@ -76,8 +77,12 @@ def autolearn_bibcode (app, bibcode):
                 curtag = line[1]
                 curtext = line[3:]
             elif line.startswith ('Retrieved '):
+                if line.endswith ('selected: 0.'):
+                    raise AutolearnError ('ADS has no record of bibcode "%s"', bibcode)
                 if not line.endswith ('selected: 1.'):
-                    die ('matched more than one publication')
+                    # Not a definite "no", so not one for the negative cache.
+                    raise PubLocateError ('bibcode "%s" matched more than one ADS record',
+                                          bibcode)
         else:
             if line[0] == '%':
                 # starting a new tag, while we had one going before.
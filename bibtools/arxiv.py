@@ -9,6 +9,7 @@ Things having to do with arxiv.org.
 from __future__ import absolute_import, division, print_function, unicode_literals
 import xml.etree.ElementTree as ET
 
+from . import AutolearnError
 from . import webutil as wu
 from .bibcore import doi_to_maybe_bibcode
 
@@ -26,7 +27,10 @@ def _translate_arxiv_name (auth):
     return auth.find (_atom_ns + 'name').text
 
 
-def autolearn_arxiv (app, arxiv):
+def autolearn_arxiv (app, arxiv, bibcode=None):
+    """`bibcode` is the publication's bibcode, if we already know it; otherwise
+    we ask ADS, if arxiv.org gives us a DOI to ask about."""
+
     url = 'http://export.arxiv.org/api/query?id_list=' + wu.urlquote (arxiv)
     info = {'arxiv': arxiv, 'keep': 0} # because we're autolearning
 
@@ -34,10 +38,13 @@ def autolearn_arxiv (app, arxiv):
     # seem to have an incremental parser built in.
 
     print ('[Parsing', url, '...]')
-    xmldoc = b''.join (wu.urlopen (url))
-    root = ET.fromstring (xmldoc)
+    root = ET.fromstring (wu.fetch_url (url))
     ent = root.find (_atom_ns + 'entry')
 
+    if ent is None or ent.findtext (_atom_ns + 'title') == 'Error':
+        # That's how the API reports malformed identifiers.
+        raise AutolearnError ('arxiv.org has no record of "%s"', arxiv)
+
     try:
         info['abstract'] = ent.find (_atom_ns + 'summary').text
     except:
@@ -64,7 +71,9 @@ def autolearn_arxiv (app, arxiv):
     except:
         pass
 
-    if 'doi' in info:
+    if bibcode is not None:
+        info['bibcode'] = bibcode
+    elif 'doi' in info:
         info['bibcode'] = doi_to_maybe_bibcode (info['doi'])
 
     return info
@@ -25,9 +25,10 @@ import re, sys
 
 from .util import *
 
-__all__ = ('parse_name encode_name normalize_surname sniff_url '
-           'classify_pub_ref doi_to_maybe_bibcode autolearn_pub '
-           'print_generic_listing parse_search').split ()
+__all__ = ('parse_name encode_name normalize_surname name_to_surname sniff_url '
+           'register_url_pattern load_url_patterns '
+           'classify_pub_ref doi_to_maybe_bibcode autolearn_pub AutolearnPool '
+           'print_generic_listing print_streaming_listing expand_year parse_search').split ()
 
 
 def parse_name (text):
@@ -51,6 +52,12 @@ def normalize_surname (name):
     return re.sub (r'\.\.+', '.', re.sub (r'[^a-z]+', '.', name.lower ()))
 
 
+def name_to_surname (name):
+    """The normalized surname of a name as stored in the database. This is
+    what goes in the "surname" column of the author_names table."""
+    return normalize_surname (parse_name (name)[1])
+
+
 _arxiv_re_1 = re.compile (r'^\d\d[01]\d\.\d+')
 _arxiv_re_2 = re.compile (r'^[a-z-]+/\d+')
 _bibcode_re = re.compile (r'^\d\d\d\d[a-zA-Z0-9&]+')
@@ -90,6 +97,13 @@ def classify_pub_ref (text):
     if text.startswith ('arxiv:'):
         return 'arxiv', text[6:]
 
+    if text.startswith ('au:'):
+        # Any author, not just the first. The year is optional.
+        if _fasy_re.match (text) is not None:
+            surname, year = text[3:].rsplit ('.', 1)
+            return 'author', normalize_surname (surname) + '.' + year
+        return 'author', normalize_surname (text[3:]) + '.*'
+
     if _fasy_re.match (text) is not None:
         # This test should go very low since it's quite open-ended.
         surname, year = text.rsplit ('.', 1)
@@ -98,46 +112,137 @@ def classify_pub_ref (text):
     return 'nickname', text
 
 
-def sniff_url (url):
-    """Should return classifiers consistent with classify_pub_ref."""
+# URL sniffing. Each pattern is a URL prefix, minus the scheme and any
+# "www.", and the kind of identifier that the rest of the URL gives. The
+# patterns are stored in a trie of dicts keyed by character, so that finding
+# the longest matching prefix costs the same however many patterns there are.
+# More can be added in the [url-patterns] section of the configuration.
+
+_url_patterns = [
+    ('adsabs.harvard.edu/abs/', 'bibcode'),
+    ('adsabs.harvard.edu/cgi-bin/nph-bib_query?bibcode=', 'bibcode'),
+    ('arxiv.org/abs/', 'arxiv'),
+    ('arxiv.org/pdf/', 'arxiv'),
+    ('doi.org/', 'doi'),
+    ('dx.doi.org/', 'doi'),
+    ('export.arxiv.org/abs/', 'arxiv'),
+    ('labs.adsabs.harvard.edu/adsabs/abs/', 'bibcode'),
+    ('labs.adsabs.harvard.edu/ui/abs/', 'bibcode'),
+    ('ui.adsabs.harvard.edu/#abs/', 'bibcode'),
+    ('ui.adsabs.harvard.edu/abs/', 'bibcode'),
+]
+
+_url_scheme_re = re.compile (r'^https?://(www\.)?', re.IGNORECASE)
+_arxiv_version_re = re.compile (r'v\d+$')
+
+def _url_rest_doi (rest):
+    from .webutil import urlunquote
+    return urlunquote (rest)
+
+def _url_rest_bibcode (rest):
+    # New-style ADS URLs can have things like "/abstract" after the bibcode.
+    from .webutil import urlunquote
+    return urlunquote (re.split (r'[/?#]', rest, 1)[0])
 
+def _url_rest_arxiv (rest):
+    # Old-style arxiv IDs contain a slash, so we can't split on them.
     from .webutil import urlunquote
+    rest = urlunquote (re.split (r'[?#]', rest, 1)[0]).rstrip ('/')
+    if rest.endswith ('.pdf'):
+        rest = rest[:-4]
+    return _arxiv_version_re.sub ('', rest)
+
+_url_rest_handlers = {
+    'arxiv': _url_rest_arxiv,
+    'bibcode': _url_rest_bibcode,
+    'doi': _url_rest_doi,
+}
+
+_url_trie = {}
+_url_cache = {}
+_url_cache_size = 4096
 
-    p = 'http://dx.doi.org/'
-    if url.startswith (p):
-        return 'doi', urlunquote (url[len (p):])
 
-    p = 'http://adsabs.harvard.edu/abs/'
-    if url.startswith (p):
-        return 'bibcode', urlunquote (url[len (p):])
+def _normalize_url (url):
+    m = _url_scheme_re.match (url)
+    if m is not None:
+        url = url[m.end ():]
+    host, slash, path = url.partition ('/')
+    return host.lower () + slash + path
 
-    p = 'http://adsabs.harvard.edu/cgi-bin/nph-bib_query?bibcode='
-    if url.startswith (p):
-        return 'bibcode', urlunquote (url[len (p):])
 
-    p = 'http://labs.adsabs.harvard.edu/ui/abs/'
-    if url.startswith (p):
-        return 'bibcode', urlunquote (url[len (p):])
+def register_url_pattern (prefix, kind):
+    """Teach sniff_url() that URLs starting with `prefix` identify pubs by
+    the `kind` of identifier in the rest of the URL. The scheme and "www."
+    are optional."""
 
-    p = 'http://labs.adsabs.harvard.edu/adsabs/abs/'
-    if url.startswith (p):
-        if url[-1] == '/':
-            url = url[:-1]
-        return 'bibcode', urlunquote (url[len (p):])
+    if kind not in _url_rest_handlers:
+        raise ValueError ('unknown URL pattern kind "%s"' % kind)
 
-    p = 'http://arxiv.org/abs/'
-    if url.startswith (p):
-        return 'arxiv', urlunquote (url[len (p):])
+    node = _url_trie
+    for c in _normalize_url (prefix):
+        node = node.setdefault (c, {})
+    node[None] = kind
+    _url_cache.clear ()
 
-    p = 'http://arxiv.org/pdf/'
-    if url.startswith (p):
-        return 'arxiv', urlunquote (url[len (p):])
 
-    return None, None
+for _prefix, _kind in _url_patterns:
+    register_url_pattern (_prefix, _kind)
+
+
+def load_url_patterns (cfg):
+    """Register the URL patterns in the [url-patterns] section of `cfg`. Each
+    item has the form "<name> = <kind> <URL prefix>", where the kind is
+    "arxiv", "bibcode", or "doi"; the name is ignored."""
+
+    if not cfg.has_section ('url-patterns'):
+        return
+
+    for name, value in cfg.items ('url-patterns'):
+        pieces = value.split ()
+
+        if len (pieces) != 2 or pieces[0] not in _url_rest_handlers:
+            die ('configuration key url-patterns/%s should have the form '
+                 '"<arxiv|bibcode|doi> <URL prefix>"; got "%s"', name, value)
+
+        register_url_pattern (pieces[1], pieces[0])
+
+
+def sniff_url (url):
+    """Should return classifiers consistent with classify_pub_ref."""
+
+    result = _url_cache.get (url)
+    if result is not None:
+        return result
+
+    result = None, None
+
+    if _url_scheme_re.match (url) is not None:
+        rest = _normalize_url (url)
+        node = _url_trie
+        kind = None
+
+        for i, c in enumerate (rest):
+            node = node.get (c)
+            if node is None:
+                break
+            if None in node:
+                # Keep going, to find the longest match.
+                kind, end = node[None], i + 1
+
+        if kind is not None:
+            value = _url_rest_handlers[kind] (rest[end:])
+            if len (value):
+                result = kind, value
+
+    if len (_url_cache) >= _url_cache_size:
+        _url_cache.clear ()
+    _url_cache[url] = result
+    return result
 
 
 def doi_to_maybe_bibcode (doi):
-    from .webutil import urlquote, urlopen
+    from .webutil import urlquote, fetch_url
 
     bibcode = None
 
@@ -149,7 +254,7 @@ def doi_to_maybe_bibcode (doi):
            urlquote (doi))
     lastnonempty = None
 
-    for line in urlopen (url):
+    for line in fetch_url (url).splitlines ():
         line = line.strip ()
         if len (line):
             lastnonempty = line
@@ -162,6 +267,88 @@ def doi_to_maybe_bibcode (doi):
     return lastnonempty
 
 
+_permanent_http_errors = frozenset ((400, 404, 410))
+
+
+def _fetch_pub_info (app, kind, text, failures, bibcode=None):
+    """Gets the info dict for a DOI, bibcode, or arxiv identifier from the web.
+    Lookups that definitely failed are appended to `failures` as (kind, ident,
+    reason) tuples, for the caller to put in the negative cache. `bibcode` is
+    what we already know about the bibcode of a DOI or arxiv identifier: the
+    bibcode, False if ADS doesn't know it, or None if we don't know. This
+    doesn't touch the database, so it may be run in a worker thread."""
+
+    from . import AutolearnError
+    from .webutil import HTTPError
+
+    doi = None
+
+    if kind == 'doi':
+        if bibcode is None:
+            # ADS seems to have better data quality.
+            bibcode = doi_to_maybe_bibcode (text)
+            if bibcode is None:
+                failures.append (('doi-bibcode', text, 'ADS has no record of DOI "%s"' % text))
+
+        if bibcode:
+            print ('[Associated', text, 'to', bibcode + ']')
+            doi, kind, text = text, 'bibcode', bibcode
+
+    try:
+        if kind == 'doi':
+            from .crossref import autolearn_doi
+            return autolearn_doi (app, text)
+
+        if kind == 'bibcode':
+            from .ads import autolearn_bibcode
+            info = autolearn_bibcode (app, text)
+            if doi is not None and info.get ('doi') is None:
+                # Otherwise we wouldn't find it by its DOI next time.
+                info['doi'] = doi
+            return info
+
+        from .arxiv import autolearn_arxiv
+        return autolearn_arxiv (app, text, bibcode or None)
+    except AutolearnError as e:
+        failures.append ((kind, text, e.bibmsg))
+        raise
+    except HTTPError as e:
+        if e.code not in _permanent_http_errors:
+            raise
+        e = AutolearnError ('cannot auto-learn %s "%s": HTTP error %d', kind, text, e.code)
+        failures.append ((kind, text, e.bibmsg))
+        raise e
+
+
+_fetchable_kinds = frozenset (('arxiv', 'bibcode', 'doi'))
+
+
+def _negcache_ttl (app):
+    return int (float (app.cfg.get_or_die ('autolearn', 'negative-cache-days')) * 86400)
+
+
+def _prepare_fetch (app, kind, text):
+    """Checks what the database already knows about fetching `text`. Raises an
+    AutolearnError if the negative cache says that looking it up is
+    pointless. Otherwise, returns the `bibcode` argument for
+    _fetch_pub_info(), from the identifier crosswalk or the negative cache."""
+
+    reason = app.db.negcache_lookup (kind, text)
+    if reason is not None:
+        from . import AutolearnError
+        raise AutolearnError ('%s (remembered from an earlier attempt; use "bib '
+                              'negcache purge %s" to try again)', reason, text)
+
+    if kind == 'bibcode':
+        return None
+
+    bibcode = app.db.crosswalk_bibcode (kind, text)
+    if bibcode is None and kind == 'doi':
+        if app.db.negcache_lookup ('doi-bibcode', text) is not None:
+            return False
+    return bibcode
+
+
 def autolearn_pub (app, text):
     kind, text = classify_pub_ref (text)
 
@@ -170,26 +357,202 @@ def autolearn_pub (app, text):
         from . import PubLocateError
         raise PubLocateError ('no such publication "%%%s"', text)
 
-    if kind == 'doi':
-        # ADS seems to have better data quality.
-        bc = doi_to_maybe_bibcode (text)
-        if bc is not None:
-            print ('[Associated', text, 'to', bc + ']')
-            kind, text = 'bibcode', bc
+    if kind in _fetchable_kinds:
+        bibcode = _prepare_fetch (app, kind, text)
+        failures = []
 
-    if kind == 'doi':
-        from .crossref import autolearn_doi
-        return autolearn_doi (app, text)
+        try:
+            return _fetch_pub_info (app, kind, text, failures, bibcode)
+        finally:
+            if len (failures):
+                app.db.negcache_add (failures, _negcache_ttl (app))
+
+    if kind == 'nfasy':
+        from .fuzzy import suggest_pub_refs
+        suggestions = suggest_pub_refs (app.db, text)
+        if len (suggestions):
+            die ('cannot auto-learn publication "%s"; did you mean %s?', text,
+                 ' or '.join (suggestions))
 
-    if kind == 'bibcode':
-        from .ads import autolearn_bibcode
-        return autolearn_bibcode (app, text)
+    die ('cannot auto-learn publication "%s"', text)
 
-    if kind == 'arxiv':
-        from .arxiv import autolearn_arxiv
-        return autolearn_arxiv (app, text)
 
-    die ('cannot auto-learn publication "%s"', text)
+class _ThreadOutput (object):
+    """Stands in for sys.stdout while autolearn workers are running. Anything
+    that a worker prints is saved up, so that it can be printed when its
+    publication's turn comes; everything else passes straight through."""
+
+    def __init__ (self, stream):
+        import threading
+        self.stream = stream
+        self.local = threading.local ()
+
+    def write (self, text):
+        buf = getattr (self.local, 'buf', None)
+        if buf is None:
+            self.stream.write (text)
+        else:
+            buf.append (text)
+
+    def __getattr__ (self, name):
+        return getattr (self.stream, name)
+
+
+class _DoneResult (object):
+    """Looks like the AsyncResult of a lookup that didn't need doing."""
+
+    def __init__ (self, value):
+        self.value = value
+
+    def ready (self):
+        return True
+
+    def wait (self, timeout=None):
+        pass
+
+    def get (self):
+        return self.value
+
+
+class AutolearnPool (object):
+    """Fetches the information needed to auto-learn many publications at once.
+
+    The web lookups for all of `textids` are started in a pool of
+    `autolearn_threads` threads, with webutil limiting how many of them talk
+    to any one server. The database is left alone until get() is called,
+    which should be done on the main thread, in whatever order the caller
+    wants the publications learned. get() prints the messages of its lookup
+    and raises its errors just as autolearn_pub() would have, so the results
+    come out the same as if the lookups had been done one at a time.
+    Identifiers in the negative cache aren't looked up at all, and DOIs
+    that are in the identifier crosswalk aren't run past ADS. `textids`
+    should be in the order that get() will be called for them; once one is
+    found that get() will fail on, such as a nickname or an identifier in
+    the negative cache, the ones after it aren't looked up either, since
+    the caller will never get to them.
+
+    Call close() when done; any lookups that haven't finished are abandoned.
+
+    """
+    autolearn_threads = 8
+
+    def __init__ (self, app, textids):
+        from multiprocessing.pool import ThreadPool
+        from . import AutolearnError
+
+        app.cfg # load it now, rather than in several threads at once
+        self.app = app
+        self.results = {}
+        todo = []
+
+        for textid in textids:
+            if textid in self.results:
+                continue
+
+            kind, text = classify_pub_ref (textid)
+            if kind not in _fetchable_kinds:
+                break # autolearn_pub() can only fail on it
+
+            # The database is consulted here, since the workers can't.
+            try:
+                bibcode = _prepare_fetch (app, kind, text)
+            except AutolearnError as e:
+                self.results[textid] = _DoneResult (('', None, e, ()))
+                break
+
+            self.results[textid] = None
+            todo.append ((textid, kind, text, bibcode))
+
+        if not len (todo):
+            self.pool = None
+            return
+
+        self.output = _ThreadOutput (sys.stdout)
+        sys.stdout = self.output
+        self.pool = ThreadPool (min (self.autolearn_threads, len (todo)))
+
+        for textid, kind, text, bibcode in todo:
+            self.results[textid] = self.pool.apply_async (self._fetch, (kind, text, bibcode))
+
+
+    def _fetch (self, kind, text, bibcode):
+        # Runs in a worker. The pool only catches Exceptions, and die() raises
+        # SystemExit, so we catch everything ourselves.
+        self.output.local.buf = buf = []
+        info = error = None
+        failures = []
+
+        try:
+            info = _fetch_pub_info (self.app, kind, text, failures, bibcode)
+        except BaseException as e:
+            error = e
+
+        return ''.join (buf), info, error, failures
+
+
+    def get (self, textid):
+        """Returns the info dict for `textid`, ready to be passed to learn_pub()."""
+
+        res = self.results.pop (textid, None)
+        if res is None:
+            return autolearn_pub (self.app, textid)
+
+        while not res.ready ():
+            res.wait (1) # with no timeout, the wait can't be interrupted
+
+        output, info, error, failures = res.get ()
+        if len (output):
+            self.output.stream.write (output)
+        if len (failures):
+            self.app.db.negcache_add (failures, _negcache_ttl (self.app))
+
+        if error is not None:
+            raise error
+        return info
+
+
+    def close (self):
+        if self.pool is None:
+            return
+
+        # Definite failures are worth remembering even if nobody asked.
+        failures = []
+
+        for res in self.results.itervalues ():
+            if res.ready ():
+                failures += res.get ()[3]
+
+        # Anything that abandoned workers print from now on goes straight
+        # out, but that's better than leaving the stand-in in place for good.
+        try:
+            self.pool.terminate ()
+        finally:
+            self.pool = None
+            sys.stdout = self.output.stream
+
+        if len (failures):
+            self.app.db.negcache_add (failures, _negcache_ttl (self.app))
+
+
+class _ChunkedWriter (object):
+    """Collects writes to a stream and passes them along in large chunks. The
+    codec wrapper around sys.stdout makes many small writes expensive."""
+
+    def __init__ (self, stream, chunksize=256):
+        self.stream = stream
+        self.chunksize = chunksize
+        self.pieces = []
+
+    def write (self, text):
+        self.pieces.append (text)
+
+    def endline (self):
+        if len (self.pieces) >= self.chunksize:
+            self.flush ()
+
+    def flush (self):
+        self.stream.write (''.join (self.pieces))
+        self.pieces = []
 
 
 def print_generic_listing (db, pub_seq, sort='year', stream=None):
@@ -203,15 +566,18 @@ def print_generic_listing (db, pub_seq, sort='year', stream=None):
         stream = sys.stdout
 
     red, reset = get_color_codes (stream, 'red', 'reset')
-
-    # TODO: number these, and save the results in a table so one can write
-    # "bib read %1" to read the top item of the most recent listing.
+    width = get_term_width (stream)
 
     for pub in pub_seq:
         nfas = pub.nfas or '(no author)'
         year = pub.year or '????'
         title = pub.title or '(no title)'
-        nick = db.choose_pub_nickname (pub.id) or ''
+
+        try:
+            nick = pub.nickname or ''
+        except AttributeError:
+            # Not from a query on db.listing_columns.
+            nick = db.choose_pub_nickname (pub.id) or ''
 
         if isinstance (year, int):
             year = '%04d' % year
@@ -231,18 +597,102 @@ def print_generic_listing (db, pub_seq, sort='year', stream=None):
         raise ValueError ('illegal print_generic_listing sort type "%s"' % sort)
 
     db.execute ('DELETE FROM publists WHERE name == ?', ('last_listing', ))
+    db.executemany ('INSERT INTO publists VALUES (?, ?, ?)',
+                    (('last_listing', i, t[4]) for i, t in enumerate (info)))
+
+    out = _ChunkedWriter (stream)
 
     for i, (nfas, year, title, nick, id) in enumerate (info):
-        print ('%s%%%-*d%s  %*s.%s  %*s  ' % (red, maxidxlen, i + 1, reset,
-                                              maxnfaslen, nfas, year,
-                                              maxnicklen, nick), end='', file=stream)
-        print_truncated (title, ofs, stream=stream, color='bold')
-        db.execute ('INSERT INTO publists VALUES (?, ?, ?)', ('last_listing',
-                                                              i, id))
+        out.write ('%s%%%-*d%s  %*s.%s  %*s  ' % (red, maxidxlen, i + 1, reset,
+                                                  maxnfaslen, nfas, year,
+                                                  maxnicklen, nick))
+        print_truncated (title, ofs, stream=out, color='bold', width=width)
+        out.endline ()
+
+    out.flush ()
+
+
+_listing_sorts = {
+    'none': '',
+    'nfas': ' ORDER BY nfas IS NULL, nfas, year IS NULL, year',
+    'year': ' ORDER BY year IS NULL, year',
+}
+
+def print_streaming_listing (db, query, args=(), sort='year', limit=None, offset=0,
+                             stream=None):
+    """Like print_generic_listing, but `query` is SQL selecting
+    db.listing_columns, and the sorting and paging are done by the database.
+    Rows are printed as they arrive, so the column widths are the largest in
+    the whole database, which SQLite can read off of indexes."""
+
+    if sort not in _listing_sorts:
+        raise ValueError ('illegal print_streaming_listing sort type "%s"' % sort)
+
+    if stream is None:
+        stream = sys.stdout
+
+    red, reset = get_color_codes (stream, 'red', 'reset')
+    width = get_term_width (stream)
+
+    maxnfaslen = db.getfirstval ('SELECT ifnull(max(length(nfas)), 0) FROM pubs')
+    if db.getfirst ('SELECT 1 FROM pubs WHERE nfas IS NULL LIMIT 1') is not None:
+        maxnfaslen = max (maxnfaslen, len ('(no author)'))
+    maxnicklen = db.getfirstval ('SELECT ifnull(max(length(nickname)), 0) FROM nicknames')
+
+    if limit is None:
+        # The largest ID is a cheap stand-in for the number of pubs.
+        maxidxlen = len (str (db.getfirstval ('SELECT ifnull(max(id), 0) FROM pubs')))
+    else:
+        maxidxlen = len (str (limit))
+
+    ofs = maxidxlen + maxnfaslen + maxnicklen + 12
+    q = db.pub_fquery ('SELECT * FROM (' + query + ')' + _listing_sorts[sort] +
+                       ' LIMIT ? OFFSET ?', *(tuple (args) + (-1 if limit is None else limit,
+                                                              offset)))
+
+    out = _ChunkedWriter (stream)
+    ids = []
+
+    for i, pub in enumerate (q):
+        year = pub.year or '????'
+        if isinstance (year, int):
+            year = '%04d' % year
+
+        out.write ('%s%%%-*d%s  %*s.%s  %*s  ' % (red, maxidxlen, i + 1, reset,
+                                                  maxnfaslen, pub.nfas or '(no author)',
+                                                  year, maxnicklen, pub.nickname or ''))
+        print_truncated (pub.title or '(no title)', ofs, stream=out, color='bold',
+                         width=width)
+        out.endline ()
+        ids.append (pub.id)
+
+    out.flush ()
+
+    # Only now, since the query might have been reading the old listing.
+    db.execute ('DELETE FROM publists WHERE name == ?', ('last_listing', ))
+    db.executemany ('INSERT INTO publists VALUES (?, ?, ?)',
+                    (('last_listing', i, id) for i, id in enumerate (ids)))
 
 
 # Searching
 
+def expand_year (year):
+    """Turn a two-digit year into a full one. If this year is 2014, 16--99 are
+    treated as 19NN, and 00--15 is treated as 20NN (for "2015 in prep"
+    papers). Other years are returned unchanged."""
+
+    if year >= 100:
+        return year
+
+    from time import localtime
+    thisyear = localtime ()[0]
+    next_twodigit_year = (thisyear + 1) % 100
+
+    if year > next_twodigit_year:
+        return year + (thisyear // 100 - 1) * 100
+    return year + (thisyear // 100) * 100
+
+
 def parse_search (interms):
     """We go to the trouble of parsing searches ourselves because ADS's syntax
     is quite verbose. Terms we support:
@@ -256,23 +706,13 @@ def parse_search (interms):
     outterms = []
     bareword = None
 
-    from time import localtime
-    thisyear = localtime ()[0]
-    next_twodigit_year = (thisyear + 1) % 100
-
     for interm in interms:
         try:
             asint = int (interm)
         except ValueError:
             pass
         else:
-            if asint < 100:
-                if asint > next_twodigit_year:
-                    outterms.append (('year', asint + (thisyear // 100 - 1) * 100))
-                else:
-                    outterms.append (('year', asint + (thisyear // 100) * 100))
-            else:
-                outterms.append (('year', asint))
+            outterms.append (('year', expand_year (asint)))
             continue
 
         # It must be the bareword
@@ -10,14 +10,15 @@ TODO: styles defined in a support file or something.
 """
 
 from __future__ import absolute_import, division, print_function, unicode_literals
-import json, sys
+import itertools, sys
 
 from .util import *
 from . import webutil as wu
 from .bibcore import *
 from .unicode_to_latex import unicode_to_latex
 
-__all__ = ('import_stream bibtexify_one export_to_bibtex write_bibtexified').split ()
+__all__ = ('import_stream import_crosswalk_stream map_bibtex_file bibtexify_one '
+           'export_to_bibtex write_bibtexified').split ()
 
 
 # Import
@@ -76,7 +77,7 @@ def _translate_bibtex_name (name):
     return first + ' ' + surname
 
 
-def _import_one (app, rec):
+def _info_from_record (rec):
     abstract = rec.get ('abstract')
     arxiv = rec.get ('eprint')
     bibcode = rec.get ('bibcode')
@@ -148,23 +149,301 @@ def _import_one (app, rec):
             continue
         refdata[k] = v
 
-    # Ready to insert.
+    # Ready to go.
 
-    info = dict (abstract=abstract, arxiv=arxiv, authors=authors,
+    return dict (abstract=abstract, arxiv=arxiv, authors=authors,
                  bibcode=bibcode, doi=doi, editors=editors,
                  nicknames=[nickname], refdata=refdata, title=title, year=year)
-    app.db.learn_pub (info)
 
 
-def import_stream (app, bibstream):
-    from .hacked_bibtexparser.bparser import BibTexParser
+def map_bibtex_file (f):
+    """Returns a read-only mmap of `f`, a file opened in binary mode, to be
+    passed to import_stream() and friends. If `f` can't be mapped, as with
+    empty files and pipes, returns `f` itself."""
+
+    import mmap
+
+    try:
+        return mmap.mmap (f.fileno (), 0, access=mmap.ACCESS_READ)
+    except (ValueError, EnvironmentError):
+        return f
+
+
+def _import_customization (rec):
     from .hacked_bibtexparser.customization import author, editor, type, convert_to_unicode
+    return editor (author (type (convert_to_unicode (rec))))
+
+
+def _record_hashes (chunk):
+    """Returns digests of the record texts in a chunk from iter_record_chunks(),
+    which take into account the @string definitions that apply to them. These
+    are how merging tells whether a record has changed, without having to
+    parse it."""
+
+    import hashlib, json
+    strings, texts = chunk[:2]
+    prefix = json.dumps (strings, sort_keys=True).encode ('utf-8') + b'\0'
+    return [hashlib.sha1 (prefix + t.encode ('utf-8')).hexdigest () for t in texts]
+
+
+def _parse_chunk (chunk, hashes):
+    from .hacked_bibtexparser.bparser import parse_record_chunk
+
+    infos = []
+
+    for rec, srchash in zip (parse_record_chunk (chunk, _import_customization), hashes):
+        if rec:
+            info = _info_from_record (rec)
+            info['srchash'] = srchash
+            infos.append (info)
+
+    return infos
+
+
+def _parse_chunk_safely (chunk, hashes):
+    # Runs in a worker process. The pool only passes Exceptions back, and
+    # die() raises SystemExit, so we catch everything ourselves.
+    try:
+        return _parse_chunk (chunk, hashes), None
+    except BaseException as e:
+        return None, e
+
+
+ingest_chunk_size = 500
+
+def _hashed_chunks (app, bibstream, start, counts=None, claimed=None):
+    """Yields (chunk, hashes, nrecords) for the records in `bibstream` after the
+    offset `start`. If `counts` is given, we're merging: records that the
+    database already has pubs for, unchanged, are dropped, and counted in
+    it as "unchanged", and the IDs of their pubs are added to the set
+    `claimed`, as by BibDB.ingest_pubs(). `nrecords` is the number of
+    records in the chunk before that."""
+
+    from .hacked_bibtexparser.bparser import iter_record_chunks
+
+    for chunk in iter_record_chunks (bibstream, ingest_chunk_size, start):
+        hashes = _record_hashes (chunk)
+        nrecords = len (hashes)
+
+        if counts is not None:
+            known = app.db.known_pub_hashes (hashes)
+
+            if len (known):
+                strings, texts, end = chunk
+                keep = [i for i, h in enumerate (hashes) if h not in known]
+                counts['unchanged'] += nrecords - len (keep)
+                claimed.update (pubid for pubids in known.itervalues () for pubid in pubids)
+                chunk = (strings, [texts[i] for i in keep], end)
+                hashes = [hashes[i] for i in keep]
+
+        yield chunk, hashes, nrecords
+
+
+def _serial_infos (chunks):
+    """Yields (infos, nrecords, end) for each of `chunks`, as from
+    _hashed_chunks()."""
+
+    for chunk, hashes, nrecords in chunks:
+        yield _parse_chunk (chunk, hashes), nrecords, chunk[2]
+
+
+def _parallel_infos (chunks, nprocs):
+    """Like _serial_infos(), but parsing the chunks in `nprocs` worker processes.
+    The results still come out in order. Only a few chunks are in flight at
+    once, so the file needn't fit in memory."""
+
+    from collections import deque
+    from multiprocessing import Pool
+
+    pool = Pool (nprocs)
+    pending = deque ()
+
+    def finish_one ():
+        res, nrecords, end = pending.popleft ()
+        while not res.ready ():
+            res.wait (1) # with no timeout, the wait can't be interrupted
+
+        infos, error = res.get ()
+        if error is not None:
+            raise error
+        return infos, nrecords, end
 
-    custom = lambda r: editor (author (type (convert_to_unicode (r))))
-    bp = BibTexParser (bibstream, customization=custom)
+    try:
+        for chunk, hashes, nrecords in chunks:
+            pending.append ((pool.apply_async (_parse_chunk_safely, (chunk, hashes)),
+                             nrecords, chunk[2]))
+
+            if len (pending) == 2 * nprocs:
+                yield finish_one ()
+
+        while len (pending):
+            yield finish_one ()
+    finally:
+        pool.terminate ()
 
-    for rec in bp.get_entry_list ():
-        _import_one (app, rec)
+
+def _hash_range (hasher, data, start, end, blocksize=1 << 20):
+    for ofs in xrange (start, end, blocksize):
+        hasher.update (data[ofs:min (ofs + blocksize, end)])
+
+
+class _ProgressMeter (object):
+    def __init__ (self, stream):
+        import time
+        self.stream = stream
+        self.start = time.time ()
+        self.nrecords = 0
+
+    def update (self, nrecords):
+        import time
+        self.nrecords += nrecords
+
+        if self.stream is not None:
+            rate = self.nrecords / max (time.time () - self.start, 1e-3)
+            print ('\r[%d records, %.0f/s]' % (self.nrecords, rate), end='',
+                   file=self.stream)
+            self.stream.flush ()
+
+    def finish (self):
+        if self.stream is not None and self.nrecords:
+            print (file=self.stream)
+
+
+def import_stream (app, bibstream, nprocs=1, merge=False, conflicts='fail',
+                   path=None, progress=None, restart=False):
+    """`bibstream` may be a file, in text or binary mode, or an mmap. Records are
+    parsed and learned as they are read, so the file needn't fit in memory.
+    If `nprocs` is more than 1, the parsing is spread over that many
+    processes; the database is still only written by this one, in the same
+    order. Each batch of records is committed as it's done.
+
+    If `merge`, records matching pubs that are already in the database
+    update them rather than being added again. Records that are exactly as
+    they were when last ingested aren't even parsed. `conflicts` is the
+    policy for nickname clashes. See BibDB.ingest_pubs(), the counts from
+    which are returned.
+
+    If `path` is given and `bibstream` is an mmap of it, a checkpoint is
+    saved with each batch. If an ingest of the same file is interrupted or
+    fails, the next one starts after the last batch that was committed, as
+    long as the file hasn't changed before that point. If `restart`, any
+    such checkpoint is discarded and the ingest starts from the beginning.
+    If `progress` is a stream, a meter of records processed is written to
+    it."""
+
+    import hashlib, mmap
+    from .db import new_ingest_counts
+
+    counts = new_ingest_counts ()
+    meter = _ProgressMeter (progress)
+    hasher = None
+    start = 0
+
+    if path is not None and isinstance (bibstream, mmap.mmap):
+        hasher = hashlib.sha1 ()
+        prev = app.db.get_ingest_checkpoint (path)
+
+        if prev is not None and restart:
+            app.db.clear_ingest_checkpoint (path)
+            print ('[Discarding the checkpoint of an unfinished ingest of "%s" at byte %d; '
+                   'starting from the beginning]' % (path, prev[0]))
+        elif prev is not None:
+            offset, digest = prev
+
+            if offset <= len (bibstream):
+                _hash_range (hasher, bibstream, 0, offset)
+
+            if offset <= len (bibstream) and hasher.hexdigest () == digest:
+                print ('[Resuming an unfinished ingest of "%s" from byte %d of %d; the records '
+                       'before that were already ingested. Use --restart to start over]'
+                       % (path, offset, len (bibstream)))
+                start = offset
+            else:
+                warn ('"%s" has changed since it was partially ingested; starting over. '
+                      'You may want to use --merge', path)
+                hasher = hashlib.sha1 ()
+
+    claimed = set ()
+    chunks = _hashed_chunks (app, bibstream, start, counts if merge else None, claimed)
+
+    if nprocs > 1:
+        chunkinfos = _parallel_infos (chunks, nprocs)
+    else:
+        chunkinfos = _serial_infos (chunks)
+
+    batch = []
+    hashed_to = start
+    end = start
+
+    try:
+        for item in itertools.chain (chunkinfos, [None]):
+            if item is not None:
+                infos, nrecords, end = item
+                batch.extend (infos)
+                meter.update (nrecords)
+
+                if len (batch) < app.db.learn_batch_size:
+                    continue
+
+            checkpoint = None
+            if hasher is not None:
+                _hash_range (hasher, bibstream, hashed_to, end)
+                hashed_to = end
+                checkpoint = (path, end, hasher.hexdigest ())
+
+            app.db.ingest_pubs (batch, merge=merge, conflicts=conflicts,
+                                checkpoint=checkpoint, counts=counts, claimed=claimed)
+            batch = []
+    finally:
+        meter.finish ()
+
+    if hasher is not None:
+        app.db.clear_ingest_checkpoint (path)
+
+    return counts
+
+
+def _crosswalk_from_record (rec):
+    bibcode = rec.get ('bibcode')
+
+    if bibcode is None and 'adsurl' in rec:
+        kind, value = sniff_url (rec['adsurl'])
+        if kind == 'bibcode':
+            bibcode = value
+
+    if bibcode is None:
+        return None
+
+    arxiv = rec.get ('eprint')
+    if arxiv is not None and arxiv.lower ().startswith ('arxiv:'):
+        arxiv = arxiv[6:]
+
+    doi = rec.get ('doi')
+    if doi is None and arxiv is None:
+        return None
+
+    return bibcode, doi, arxiv
+
+
+def import_crosswalk_stream (app, bibstream):
+    """Fill in the identifier crosswalk from a BibTeX file exported from ADS,
+    without learning any publications. Returns the number of records that
+    had something to add."""
+
+    from .hacked_bibtexparser.bparser import iter_records
+    from .hacked_bibtexparser.customization import convert_to_unicode
+
+    n = [0]
+
+    def entries ():
+        for rec in iter_records (bibstream, convert_to_unicode):
+            entry = _crosswalk_from_record (rec)
+            if entry is not None:
+                n[0] += 1
+                yield entry
+
+    app.db.crosswalk_add (entries ())
+    return n[0]
 
 
 # Export
@@ -202,22 +481,24 @@ class BibtexStyleBase (object):
     def _massage_pub (self, db, pub, rd):
         pass
 
-    def render_pub (self, db, pub):
+    def render_pub (self, db, pub, authors=None):
         """Returns a dict in which the values are already latex-encoded.
-        '_type' is the bibtex type, '_ident' is the bibtex identifier."""
+        '_type' is the bibtex type, '_ident' is the bibtex identifier.
+        `authors` is this pub's entry in the result of
+        `db.get_authors_for_pubs()`; it's fetched if not provided."""
 
-        rd = json.loads (pub.refdata)
+        if authors is None:
+            authors = db.get_authors_for_pubs ((pub.id, ))[pub.id]
 
-        for k in rd.keys ():
-            rd[k] = unicode_to_latex (rd[k])
+        rd = dict ((k, unicode_to_latex (v)) for k, v in pub.refdict.iteritems ())
 
         self._massage_pub (db, pub, rd)
 
-        names = list (db.get_pub_authors (pub.id, 'author'))
+        names = authors['author']
         if len (names):
             rd['author'] = self.render_names (names)
 
-        names = list (db.get_pub_authors (pub.id, 'editor'))
+        names = authors['editor']
         if len (names):
             rd['editor'] = self.render_names (names)
 
@@ -351,7 +632,7 @@ def export_to_bibtex (app, style, citednicks, write=None):
         write = sys.stdout.write
 
     seenids = {}
-    first = True
+    pubs = []
 
     for nick in sorted (citednicks):
         curs = app.db.pub_fquery ('SELECT p.* FROM pubs AS p, nicknames AS n '
@@ -373,12 +654,17 @@ def export_to_bibtex (app, style, citednicks, write=None):
             die ('no reference data for "%s"', nick)
 
         seenids[pub.id] = nick
+        pubs.append (pub)
+
+    authors = app.db.get_authors_for_pubs (seenids.iterkeys ())
+    first = True
 
+    for pub in pubs:
         if first:
             first = False
         else:
             write ('\n')
 
-        bt = style.render_pub (app.db, pub)
-        bt['_ident'] = nick
+        bt = style.render_pub (app.db, pub, authors[pub.id])
+        bt['_ident'] = seenids[pub.id]
         write_bibtexified (write, bt)
@@ -7,17 +7,85 @@ The command-line interface.
 """
 
 from __future__ import absolute_import, division, print_function, unicode_literals
-import codecs, io, json, os.path, sys
+import codecs, io, os.path, sys
 
 from pwkit.cli import multitool, pop_option
 
 from . import BibError, webutil as wu
 from .util import *
-from .bibcore import print_generic_listing, parse_search
+from .bibcore import print_generic_listing, print_streaming_listing, parse_search
 
 __all__ = ['driver']
 
 
+def _option_flag (name):
+    # Same convention as pwkit's pop_option().
+    if len (name) == 1:
+        return '-' + name
+    return '--' + name
+
+
+def pop_valued_option (name, args, default=None):
+    """Like pwkit's pop_option(), but for an option that takes a value, given as
+    either "--name=value" or "--name value" for long options, or "-nvalue" or
+    "-n value" for one-letter ones. Returns `default` if the option is
+    absent."""
+
+    flag = _option_flag (name)
+    joined = flag if len (name) == 1 else flag + '='
+
+    for i, arg in enumerate (args):
+        if arg == flag:
+            if i + 1 == len (args):
+                raise multitool.UsageError ('option %s needs a value', flag)
+            value = args[i+1]
+            del args[i:i+2]
+            return value
+
+        if arg.startswith (joined):
+            del args[i]
+            return arg[len (joined):]
+
+    return default
+
+
+def expand_stdin_args (args):
+    """Replace an argument of "-" with the identifiers read from standard
+    input, one per line. Blank lines and lines starting with "#" are
+    ignored."""
+
+    if '-' not in args:
+        return args
+
+    result = []
+
+    for arg in args:
+        if arg != '-':
+            result.append (arg)
+            continue
+
+        for line in sys.stdin:
+            line = line.strip ()
+            if len (line) and not line.startswith (b'#'):
+                result.append (line)
+
+    return result
+
+
+def pop_int_option (name, args, default=None):
+    value = pop_valued_option (name, args)
+    if value is None:
+        return default
+
+    try:
+        value = int (value)
+        assert value >= 0
+    except Exception:
+        raise multitool.UsageError ('option %s needs a nonnegative integer value',
+                                    _option_flag (name))
+    return value
+
+
 class Ads (multitool.Command):
     name = 'ads'
     argspec = '<pub>'
@@ -139,29 +207,58 @@ class Btprint (multitool.Command):
 
 class CanonJournal (multitool.Command):
     name = 'canon-journal'
-    argspec = '<old-journal-name> <new-journal-name> [new-journal-ISSN]'
+    argspec = '[-n] {<old-journal-name> <new-journal-name> [new-journal-ISSN] | --map <file>}'
     summary = 'Canonicalize a journal name in the reference data.'
+    more_help = """With --map, the renames are read from a file with one per line, in the
+form "<old-name> TAB <new-name> [TAB <new-ISSN>]". Blank lines and lines
+starting with "#" are ignored. With -n, just report how many publications
+would be changed."""
 
     def invoke (self, args, app=None, **kwargs):
-        if len (args) not in (2, 3):
-            raise multitool.UsageError ('expected 2 or 3 arguments')
+        dryrun = pop_option ('n', args)
+        mapmode = pop_option ('map', args)
+
+        if mapmode:
+            if len (args) != 1:
+                raise multitool.UsageError ('expected exactly 1 argument with --map')
+
+            renames = []
+
+            with io.open (args[0], 'rt') as f:
+                for lineno, line in enumerate (f):
+                    line = line.rstrip ('\r\n')
+                    if not len (line.strip ()) or line.startswith ('#'):
+                        continue
+
+                    bits = line.split ('\t')
+                    if len (bits) not in (2, 3):
+                        die ('%s:%d: expected 2 or 3 tab-separated fields',
+                             args[0], lineno + 1)
+                    renames.append (bits)
+        else:
+            if len (args) not in (2, 3):
+                raise multitool.UsageError ('expected 2 or 3 arguments')
+            renames = [args]
 
-        oldjournal = args[0]
-        newjournal = args[1]
-        newissn = args[2] if len (args) > 2 else None
+        # All of this happens in one transaction, committed at exit.
+        total = 0
 
-        for pub in app.db.pub_query ('refdata NOT NULL'):
-            rd = json.loads (pub.refdata)
-            if rd.get ('journal', '') != oldjournal:
-                continue
+        for rename in renames:
+            oldjournal = rename[0]
+            newjournal = rename[1]
+            newissn = rename[2] if len (rename) > 2 else None
 
-            rd['journal'] = newjournal
+            n = app.db.canonicalize_journal (oldjournal, newjournal, newissn,
+                                             dryrun=dryrun)
+            total += n
 
-            if 'issn' not in rd and newissn is not None:
-                rd['issn'] = newissn
+            if dryrun or mapmode:
+                print ('%s -> %s: %d' % (oldjournal, newjournal, n))
 
-            app.db.execute ('UPDATE pubs SET refdata = ? WHERE id == ?',
-                            (json.dumps (rd), pub.id))
+        if dryrun:
+            print ('%d publications would be changed' % total)
+        elif mapmode:
+            print ('%d publications changed' % total)
 
 
 class _Complete (multitool.Command):
@@ -179,6 +276,55 @@ class _Complete (multitool.Command):
         completions.process (app, tool, subcommand, args[1:])
 
 
+class Crosswalk (multitool.DelegatingCommand):
+    name = 'crosswalk'
+    summary = 'Manage the table relating DOIs, bibcodes, and arxiv identifiers.'
+
+    class Load (multitool.Command):
+        name = 'load'
+        argspec = '<bibtex-file>'
+        summary = 'Fill in the crosswalk from a BibTeX file exported from ADS.'
+        more_help = """The publications themselves aren't learned, but DOIs and arxiv identifiers
+in the file can then be auto-learned without asking ADS for their bibcodes."""
+
+        def invoke (self, args, app=None, **kwargs):
+            from .bibtex import import_crosswalk_stream, map_bibtex_file
+
+            if len (args) != 1:
+                raise multitool.UsageError ('expected exactly 1 argument')
+
+            with io.open (args[0], 'rb') as f:
+                n = import_crosswalk_stream (app, map_bibtex_file (f))
+
+            print ('[Loaded %d crosswalk entr%s]' % (n, 'y' if n == 1 else 'ies'))
+
+
+    class Show (multitool.Command):
+        name = 'show'
+        argspec = '<identifier>'
+        summary = 'Show what the crosswalk knows about a DOI, bibcode, or arxiv identifier.'
+
+        def invoke (self, args, app=None, **kwargs):
+            from .bibcore import classify_pub_ref
+
+            if len (args) != 1:
+                raise multitool.UsageError ('expected exactly 1 argument')
+
+            kind, text = classify_pub_ref (args[0])
+            if kind not in ('arxiv', 'bibcode', 'doi'):
+                die ('"%s" is not a DOI, bibcode, or arxiv identifier', args[0])
+
+            found = False
+            for row in app.db.execute ('SELECT bibcode, doi, arxiv FROM crosswalk '
+                                       'WHERE %s == ?' % kind, (text, )):
+                found = True
+                for label, value in zip (('bibcode', 'doi', 'arxiv'), row):
+                    print ('%-8s %s' % (label + ':', value or '(unknown)'))
+
+            if not found:
+                die ('the crosswalk doesn\'t know about "%s"', text)
+
+
 class Delete (multitool.Command):
     name = 'delete'
     argspec = '<pub>'
@@ -314,52 +460,35 @@ class ForgetPDF (multitool.Command):
 
 class Grep (multitool.Command):
     name = 'grep'
-    argspec = '[-i][-f][-r] <pattern>'
+    argspec = '[-i][-f][-r][-w] <pattern>'
     summary = 'Search for text in the bibliographic database.'
+    more_help = """By default, <pattern> is a regular expression. With -f, it is a
+plain string; with -w, it is a word query (e.g. 'brown dwarf*', '"radio
+emission" NOT flare') whose results are listed in order of relevance. -i makes
+regular expressions case-insensitive; word queries always are. -r searches
+identifiers and reference data rather than titles and abstracts.
+
+Patterns are narrowed down with the word index when they contain whole words,
+like 'magnetic flare'. Others, like 'magnet.*flare' (with or without -i), are
+checked against every publication, which is slow for big databases, unless the
+"substring-index" key of the [db] configuration section is turned on."""
 
     def invoke (self, args, app=None, **kwargs):
-        import re
+        from .fulltext import grep_pubs
 
         nocase = pop_option ('i', args)
         fixed = pop_option ('f', args)
         refinfo = pop_option ('r', args)
+        words = pop_option ('w', args)
 
         if len (args) != 1:
             raise multitool.UsageError ('expected exactly 1 non-option argument')
 
-        regex = args[0]
-
-        if refinfo:
-            fields = ['arxiv', 'bibcode', 'doi', 'refdata']
-        else:
-            fields = ['title', 'abstract']
-
         try:
-            # Could use the Sqlite REGEXP machinery, but it should be somewhat
-            # faster to precompile the regex. Premature optimization FTW.
-
-            if fixed:
-                def rmatch (i):
-                    if i is None:
-                        return False
-                    return regex in i
-            else:
-                flags = 0
-
-                if nocase:
-                    flags |= re.IGNORECASE
-
-                comp = re.compile (regex, flags)
-
-                def rmatch (i):
-                    if i is None:
-                        return False
-                    return comp.search (i) is not None
-
-            app.db.create_function ('rmatch', 1, rmatch)
-            q = app.db.pub_fquery ('SELECT * FROM pubs WHERE ' +
-                                   '||'.join ('rmatch(%s)' % f for f in fields))
-            print_generic_listing (app.db, q)
+            q = grep_pubs (app.db, args[0], fixed=fixed, nocase=nocase,
+                           refinfo=refinfo, words=words,
+                           columns=app.db.listing_columns)
+            print_generic_listing (app.db, q, sort=None if words else 'year')
         except Exception as e:
             die (e)
 
@@ -372,6 +501,7 @@ class Group (multitool.DelegatingCommand):
         name = 'add'
         argspec = '<group> <pubs...>'
         summary = 'Add publications to a group.'
+        more_help = 'An argument of "-" reads identifiers from standard input, one per line.'
 
         def invoke (self, args, app=None, **kwargs):
             if len (args) < 2:
@@ -382,7 +512,7 @@ class Group (multitool.DelegatingCommand):
             dbgroupname = 'user_' + groupname
 
             try:
-                for pub in app.locate_pubs (args[1:], autolearn=True):
+                for pub in app.locate_pubs (expand_stdin_args (args[1:]), autolearn=True):
                     app.db.execute ('INSERT OR IGNORE INTO publists VALUES (?, '
                                     '  (SELECT ifnull(max(idx)+1,0) FROM publists WHERE name == ?), '
                                     '?)', (dbgroupname, dbgroupname, pub.id))
@@ -413,7 +543,8 @@ class Group (multitool.DelegatingCommand):
                     # FIXME: check groupname to avoid "bib group add abc+12 xyz+10" mistake
                     dbgroupname = 'user_' + groupname
 
-                    q = app.db.pub_fquery ('SELECT p.* FROM pubs AS p, publists AS pl '
+                    q = app.db.pub_fquery ('SELECT ' + app.db.listing_columns + ' '
+                                           'FROM pubs AS p, publists AS pl '
                                            'WHERE p.id == pl.pubid AND pl.name == ? '
                                            'ORDER BY pl.idx', dbgroupname)
                     print_generic_listing (app.db, q)
@@ -490,7 +621,7 @@ class Info (multitool.Command):
         year = pub.year or 'no year'
         title = pub.title or '(no title)'
 
-        authors = list (app.db.get_pub_authors (pub.id))
+        authors = app.db.get_authors_for_pubs ((pub.id, ), ('author', ))[pub.id]['author']
         if len (authors) > 10:
             authstr = ', '.join (a[1] for a in authors[:10]) + ' ...'
         elif len (authors):
@@ -515,7 +646,7 @@ class Info (multitool.Command):
         if pub.doi is not None:
             print (red + 'DOI:' + reset, pub.doi)
         if pub.refdata is not None:
-            rd = json.loads (pub.refdata)
+            rd = dict (pub.refdict)
             txt = red + '~BibTeX:' + reset + ' @%s {' % rd.pop ('_type')
             def fmt (t):
                 k, v = t
@@ -535,19 +666,63 @@ class Info (multitool.Command):
 
 class Ingest (multitool.Command):
     name = 'ingest'
-    argspec = '<bibtex-file>'
+    argspec = '[-j N] [--merge] [--conflicts=fail|skip|rename] [--restart] <bibtex-file>'
     summary = 'Ingest information from a BibTeX file.'
+    more_help = """With -j, the records are parsed by N processes at once. They're still
+added to the database in the order that they appear in the file.
+
+With --merge, records that match publications already in the database, by
+DOI, bibcode, arxiv identifier, or nickname, update them rather than being
+added again, and ones that haven't changed since they were last ingested
+are skipped. This is the way to re-ingest a file that has been edited.
+
+--conflicts says what to do with a new record whose nickname is already
+taken: stop with an error (the default), skip it, or rename it by adding
+"-2", "-3", etc. When merging, a record that matches the same publication as
+an earlier record of the file is a conflict too: it's an error, or else it's
+skipped and counted as ambiguous, so that the first record always wins.
+
+Records are committed in batches as they're ingested. If an ingest stops
+partway through, running it again picks up after the last batch that was
+committed, unless the file has been changed before that point. A note is
+printed saying so, and giving the byte offset that the ingest resumes from.
+With --restart, that checkpoint is thrown away and the whole file is
+ingested; add --merge so that the records that the earlier run committed
+aren't added a second time."""
 
     def invoke (self, args, app=None, **kwargs):
-        from .bibtex import import_stream
+        from .bibtex import import_stream, map_bibtex_file
+
+        nprocs = pop_int_option ('j', args, 1)
+        merge = pop_option ('merge', args)
+        conflicts = pop_valued_option ('conflicts', args, 'fail')
+        restart = pop_option ('restart', args)
+
+        if conflicts not in app.db.conflict_policies:
+            raise multitool.UsageError ('option --conflicts must be one of: %s',
+                                        ', '.join (app.db.conflict_policies))
 
         if len (args) != 1:
             raise multitool.UsageError ('expected exactly 1 argument')
 
         bibpath = args[0]
+        progress = sys.stderr if sys.stderr.isatty () else None
 
-        with io.open (bibpath, 'rt') as f:
-            import_stream (app, f)
+        with io.open (bibpath, 'rb') as f:
+            counts = import_stream (app, map_bibtex_file (f), nprocs=max (nprocs, 1),
+                                    merge=merge, conflicts=conflicts,
+                                    path=os.path.realpath (bibpath), progress=progress,
+                                    restart=restart)
+
+        fields = ['new']
+        if merge:
+            fields += ['changed', 'unchanged', 'ambiguous']
+        if conflicts == 'skip':
+            fields.append ('skipped')
+        elif conflicts == 'rename':
+            fields.append ('renamed')
+
+        print ('[' + ', '.join ('%d %s' % (counts[f], f) for f in fields) + ']')
 
 
 class Jpage (multitool.Command):
@@ -571,14 +746,91 @@ class Jpage (multitool.Command):
 
 class List (multitool.Command):
     name = 'list'
-    argspec = '<pubs...>'
+    argspec = '[--limit=N] [--offset=N] [--sort=year|nfas|none] <pubs...>'
     summary = 'List publications in the database.'
+    more_help = """If any of --limit, --offset or --sort are given, the sorting and paging
+are done by the database and results are printed as they are found, which is
+much faster for large listings. The columns are then sized for the largest
+entries in the whole database. The default sort is by year.
+
+An argument of "-" reads identifiers from standard input, one per line."""
 
     def invoke (self, args, app=None, **kwargs):
+        limit = pop_int_option ('limit', args)
+        offset = pop_int_option ('offset', args)
+        sort = pop_valued_option ('sort', args)
+
         if len (args) < 1:
             raise multitool.UsageError ('expected arguments')
 
-        print_generic_listing (app.db, app.locate_pubs (args, noneok=True))
+        args = expand_stdin_args (args)
+
+        if limit is None and offset is None and sort is None:
+            print_generic_listing (app.db, app.locate_pubs (args, noneok=True,
+                                                            columns=app.db.listing_columns))
+            return
+
+        if sort is None:
+            sort = 'year'
+        elif sort not in ('year', 'nfas', 'none'):
+            raise multitool.UsageError ('--sort must be "year", "nfas", or "none"')
+
+        try:
+            refs = [app.parse_pub_ref (a) for a in args]
+        except BibError as e:
+            die (e)
+
+        print_streaming_listing (app.db, app.db.pub_refs_query (refs, app.db.listing_columns),
+                                 sort=sort, limit=limit, offset=offset or 0)
+
+
+class Negcache (multitool.DelegatingCommand):
+    name = 'negcache'
+    summary = 'Manage the cache of identifiers that couldn\'t be auto-learned.'
+
+    class List (multitool.Command):
+        name = 'list'
+        argspec = ''
+        summary = 'List the identifiers that won\'t be looked up again, and why.'
+        help_if_no_args = False
+
+        def invoke (self, args, app=None, **kwargs):
+            if len (args):
+                raise multitool.UsageError ('expected no arguments')
+
+            import time
+            now = int (time.time ())
+
+            for kind, ident, reason, expires in app.db.execute ('SELECT * FROM negcache '
+                                                                'ORDER BY kind, ident'):
+                if expires <= now:
+                    until = 'expired'
+                else:
+                    until = time.strftime ('%Y-%m-%d', time.localtime (expires))
+                print ('%-11s %-24s %-10s %s' % (kind, ident, until, reason))
+
+
+    class Purge (multitool.Command):
+        name = 'purge'
+        argspec = '[--expired] [identifiers...]'
+        summary = 'Forget failed lookups, so that they\'ll be tried again.'
+        more_help = 'With no arguments, everything is forgotten.'
+        help_if_no_args = False
+
+        def invoke (self, args, app=None, **kwargs):
+            from .bibcore import classify_pub_ref
+
+            expired = pop_option ('expired', args)
+
+            if not len (args):
+                n = app.db.negcache_purge (expired=expired)
+            else:
+                n = 0
+                for arg in args:
+                    kind, text = classify_pub_ref (arg)
+                    n += app.db.negcache_purge (ident=text, expired=expired)
+
+            print ('[Forgot %d cached failure%s]' % (n, '' if n == 1 else 's'))
 
 
 class Pdfpath (multitool.Command):
@@ -639,7 +891,8 @@ class Recent (multitool.Command):
         if len (args) != 0:
             raise multitool.UsageError ('expected no arguments')
 
-        pubs = app.db.pub_fquery ('SELECT DISTINCT p.* FROM pubs AS p, history AS h '
+        pubs = app.db.pub_fquery ('SELECT DISTINCT ' + app.db.listing_columns + ' '
+                                  'FROM pubs AS p, history AS h '
                                   'WHERE p.id == h.pubid ORDER BY date DESC LIMIT 10')
         print_generic_listing (app.db, pubs, sort=None)
 
@@ -674,6 +927,55 @@ class Rsbackup (multitool.Command):
         app.rsync_backup ()
 
 
+class Search (multitool.Command):
+    name = 'search'
+    argspec = '[--explain] <terms...>'
+    summary = 'Search the local database.'
+    more_help = """Publications matching all of the terms are listed. Terms are:
+
+  au:NAME, author:NAME  someone with the surname NAME is an author or editor
+  year:Y, year:Y1-Y2    published in year Y or in a range; either end may be open
+  journal:NAME          published in the journal NAME, as written in the database
+  issn:ISSN             published in the journal with the given ISSN
+  group:NAME            in the group NAME
+  pdf:yes, pdf:no       whether the full-text PDF has been saved
+  title:WORDS           the title contains the words WORDS, in order
+  doi:, bibcode:, arxiv:, nick:  identifiers
+
+A bare number is a year, and any other bare word is an author surname. Prefix
+a term with "-" to negate it. With --explain, print the SQL and the query plan
+instead of searching, and warn about any tables that have to be read in full."""
+
+    def invoke (self, args, app=None, **kwargs):
+        from .search import compile_search, explain_search
+
+        explain = pop_option ('explain', args)
+
+        if len (args) < 1:
+            raise multitool.UsageError ('expected arguments')
+
+        sql, sqlargs = compile_search (app.db, args, app.db.listing_columns)
+
+        if not explain:
+            print_generic_listing (app.db, app.db.pub_fquery (sql, *sqlargs))
+            return
+
+        print (sql)
+        print ('with arguments:', ', '.join (repr (a) for a in sqlargs))
+        print ()
+
+        steps, scans = explain_search (app.db, sql, sqlargs)
+
+        for depth, detail in steps:
+            print ('  ' * depth + detail)
+
+        print ()
+        if not len (scans):
+            print ('No full table scans.')
+        else:
+            print ('Full table scans of:', ', '.join (scans))
+
+
 class Setpdf (multitool.Command):
     name = 'setpdf'
     argspec = '<pub> <pdf-path>'
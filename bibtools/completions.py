@@ -58,6 +58,9 @@ def _complete_pub_common (app, args, is_multi):
     if partial[0] in string.letters:
         print_nfasys (app, partial, is_multi)
 
+    if stem_compatible ('au:', partial):
+        print_authors (app, partial)
+
     print_arxivs (app, partial)
     print_nicknames (app, partial)
     # TODO: percent IDs; "doi:...", "arxiv:..."
@@ -83,6 +86,12 @@ def print_bibcodes (app, partial):
 
 
 def print_nfasys (app, partial, is_multi):
+    if not app.db.getfirst ('SELECT 1 FROM nfas_names WHERE nfas >= ? AND nfas < ?',
+                            partial.rsplit ('.', 1)[0], partial + '\x7f'):
+        # Nothing starts like this, so maybe it's a typo.
+        print_fuzzy_nfasys (app, partial)
+        return
+
     # Case where the year hasn't yet been provided
     if is_multi:
         for tup in app.db.execute ('SELECT DISTINCT nfas FROM pubs WHERE '
@@ -106,6 +115,37 @@ def print_nfasys (app, partial, is_multi):
             print (nfas + '.' + str (tup[0]))
 
 
+def print_authors (app, partial):
+    if len (partial) < 3:
+        print ('au:')
+        return
+
+    # Surnames are normalized to lowercase ASCII, so this range is exactly
+    # the ones starting with the partial, and unlike LIKE it can use the
+    # index.
+    stem = partial[3:]
+    for tup in app.db.execute ('SELECT DISTINCT surname FROM author_names WHERE '
+                               'surname >= ? AND surname < ?', (stem, stem + '\x7f')):
+        print ('au:' + tup[0])
+
+
+def print_fuzzy_nfasys (app, partial):
+    from .bibcore import normalize_surname
+    from .fuzzy import suggest_nfasy
+
+    nfas, year = partial, None
+    head, _, tail = partial.rpartition ('.')
+
+    if len (head) and (tail.isdigit () or not len (tail)):
+        # There's a (maybe partial) year.
+        nfas = head
+        if len (tail) == 4:
+            year = int (tail)
+
+    for text in suggest_nfasy (app.db, normalize_surname (nfas), year):
+        print (text)
+
+
 def print_arxivs (app, partial):
     for tup in app.db.execute ('SELECT arxiv FROM pubs WHERE '
                                'arxiv LIKE ?', (partial + '%', )):
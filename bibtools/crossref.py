@@ -9,7 +9,7 @@ Things related to the CrossRef/DOI/OpenURL system.
 from __future__ import absolute_import, division, print_function, unicode_literals
 import xml.etree.ElementTree as ET
 
-from .util import die
+from . import AutolearnError
 from . import webutil as wu
 
 __all__ = ('autolearn_doi stream_doi').split ()
@@ -24,12 +24,16 @@ def _translate_unixref_name (personelem):
     return given + ' ' + sur.replace (' ', '_')
 
 
+def _doi_url (app, doi):
+    apikey = app.cfg.get_or_die ('api-keys', 'crossref')
+    return ('http://crossref.org/openurl/?id=%s&noredirect=true&pid=%s&'
+            'format=unixref' % (wu.urlquote (doi), wu.urlquote (apikey)))
+
+
 def stream_doi (app, doi):
     """Returns tuple of URL string and a urlopen() return value."""
 
-    apikey = app.cfg.get_or_die ('api-keys', 'crossref')
-    url = ('http://crossref.org/openurl/?id=%s&noredirect=true&pid=%s&'
-           'format=unixref' % (wu.urlquote (doi), wu.urlquote (apikey)))
+    url = _doi_url (app, doi)
     return url, wu.urlopen (url)
 
 
@@ -41,9 +45,12 @@ def autolearn_doi (app, doi):
     # XXX sad to not parse the XML incrementally, but Py 2.x doesn't seem to
     # have an incremental parser built in (!)
 
-    url, handle = stream_doi (app, doi)
+    url = _doi_url (app, doi)
     print ('[Parsing', url, '...]')
-    root = ET.fromstring (b''.join (handle))
+    root = ET.fromstring (wu.fetch_url (url))
+
+    if root.find ('doi_record/crossref/error') is not None:
+        raise AutolearnError ('Crossref has no record of DOI "%s"', doi)
 
     infotop = root.find ('doi_record/crossref/journal')
     if infotop is not None:
@@ -61,7 +68,7 @@ def autolearn_doi (app, doi):
             yearpath = 'publication_date/year'
 
     if infotop is None:
-        die ('don\'t know how to interpret UnixRef XML for %s', doi)
+        raise AutolearnError ('don\'t know how to interpret UnixRef XML for %s', doi)
 
     # OK, now we can fill in the info.
 
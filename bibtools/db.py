@@ -7,40 +7,571 @@ The main database.
 """
 
 from __future__ import absolute_import, division, print_function, unicode_literals
-import collections, json, sqlite3, sys
+import collections, itertools, json, sqlite3, sys
 
 from . import PubLocateError, MultiplePubsError
 from .util import *
 from .bibcore import *
 
-__all__ = ('connect init').split ()
+__all__ = ('apply_profile connect init new_ingest_counts upgrade').split ()
 
 
 dbpath = bibpath ('db.sqlite3')
 
-def connect ():
-    return sqlite3.connect (dbpath, factory=BibDB)
+def connect (cfg, path=None, create=False):
+    """Open the database, tuned and upgraded as `cfg` says. If `create`, the
+    database is a new one, which is first given the schema of version 0."""
+
+    db = sqlite3.connect (path or dbpath, factory=BibDB)
+    if 'json1' not in sqlite_features (db):
+        _provide_json_functions (db)
+    apply_profile (db, cfg)
+    if create:
+        db.executescript (datastream ('schema.sql').read ())
+    upgrade (db, cfg)
+    return db
+
+
+# Performance tuning. These settings come from the [db] section of the
+# configuration, and map onto SQLite pragmas. `None` means an integer.
+
+_profile_pragmas = {
+    'busy-timeout': ('busy_timeout', None),
+    'cache-size': ('cache_size', None),
+    'journal-mode': ('journal_mode', 'delete truncate persist memory wal off'),
+    'mmap-size': ('mmap_size', None),
+    'synchronous': ('synchronous', 'off normal full extra'),
+    'temp-store': ('temp_store', 'default file memory'),
+}
+
+def apply_profile (db, cfg):
+    for key, (pragma, choices) in sorted (_profile_pragmas.iteritems ()):
+        if not cfg.has_option ('db', key):
+            continue
+
+        value = cfg.get ('db', key).strip ().lower ()
+
+        if choices is None:
+            try:
+                value = int (value)
+            except ValueError:
+                die ('configuration key db/%s must be an integer; got "%s"',
+                     key, value)
+        elif value not in choices.split ():
+            die ('configuration key db/%s must be one of: %s; got "%s"',
+                 key, ', '.join (choices.split ()), value)
+
+        db.execute ('PRAGMA %s = %s' % (pragma, value))
 
 
 def init (app):
     import os.path
 
-    init = datastream ('schema.sql').read ()
-
     mkdir_p (bibpath ())
 
     if os.path.exists (dbpath):
         die ('the file "%s" already exists', dbpath)
 
     try:
-        app.db.executescript (init)
+        connect (app.cfg, create=True).close ()
     except sqlite3.OperationalError as e:
         die ('cannot initialize "%s": %s', dbpath, e)
 
 
-PubRow = collections.namedtuple ('PubRow',
-                                 'id abstract arxiv bibcode doi keep nfas '
-                                 'refdata title year'.split ())
+# Schema migrations. `schema.sql` describes version 0 of the database; each
+# entry in this list upgrades the schema by one version, and we record the
+# current version in the "user_version" header field. Only ever append to
+# this list, since existing databases depend on the numbering.
+
+_migrations = [
+    # 1: lookup indexes for the hot queries.
+    '''
+    CREATE INDEX pubs_doi ON pubs (doi);
+    CREATE INDEX pubs_bibcode ON pubs (bibcode);
+    CREATE INDEX pubs_arxiv ON pubs (arxiv);
+    CREATE INDEX pubs_nfas_year ON pubs (nfas, year);
+    CREATE INDEX authors_pubid ON authors (pubid, type, idx);
+    CREATE INDEX nicknames_pubid ON nicknames (pubid);
+    CREATE INDEX publists_name_idx ON publists (name, idx);
+    CREATE INDEX history_pubid ON history (pubid, date);
+    ''',
+
+    # 2: the commonly-queried refdata items, pulled out of the JSON into a
+    # table that we can index.
+    '''
+    CREATE TABLE refkeys (
+           pubid INTEGER UNIQUE PRIMARY KEY NOT NULL,
+           type TEXT,
+           journal TEXT,
+           issn TEXT,
+           volume TEXT,
+           pages TEXT,
+           FOREIGN KEY (pubid) REFERENCES pubs(id)
+    );
+    CREATE INDEX refkeys_type ON refkeys (type);
+    CREATE INDEX refkeys_journal ON refkeys (journal, volume, pages);
+    CREATE INDEX refkeys_issn ON refkeys (issn, volume, pages);
+    INSERT INTO refkeys
+      SELECT id, json_extract(refdata, '$._type'),
+        json_extract(refdata, '$.journal'), json_extract(refdata, '$.issn'),
+        json_extract(refdata, '$.volume'), json_extract(refdata, '$.pages')
+      FROM pubs WHERE refdata NOT NULL;
+    CREATE TRIGGER refkeys_insert AFTER INSERT ON pubs WHEN new.refdata NOT NULL BEGIN
+      INSERT INTO refkeys VALUES (new.id, json_extract(new.refdata, '$._type'),
+        json_extract(new.refdata, '$.journal'), json_extract(new.refdata, '$.issn'),
+        json_extract(new.refdata, '$.volume'), json_extract(new.refdata, '$.pages'));
+    END;
+    CREATE TRIGGER refkeys_delete AFTER DELETE ON pubs BEGIN
+      DELETE FROM refkeys WHERE pubid == old.id;
+    END;
+    CREATE TRIGGER refkeys_update AFTER UPDATE OF id, refdata ON pubs BEGIN
+      DELETE FROM refkeys WHERE pubid == old.id;
+      INSERT INTO refkeys SELECT new.id, json_extract(new.refdata, '$._type'),
+        json_extract(new.refdata, '$.journal'), json_extract(new.refdata, '$.issn'),
+        json_extract(new.refdata, '$.volume'), json_extract(new.refdata, '$.pages')
+        WHERE new.refdata NOT NULL;
+    END;
+    ''',
+
+    # 3: column widths for streaming listings.
+    '''
+    CREATE INDEX pubs_nfas_length ON pubs (length(nfas));
+    CREATE INDEX nicknames_length ON nicknames (length(nickname));
+    ''',
+
+    # 4: lookups for "bib search".
+    '''
+    CREATE INDEX pubs_year ON pubs (year);
+    CREATE INDEX authors_authid ON authors (authid, pubid);
+    CREATE INDEX pdfs_pubid ON pdfs (pubid);
+    ''',
+
+    # 5: the normalized surname of every author, for finding pubs by any of
+    # their authors. Computed by the name_to_surname() SQL function that
+    # upgrade() provides.
+    '''
+    ALTER TABLE author_names ADD COLUMN surname TEXT;
+    UPDATE author_names SET surname = name_to_surname(name);
+    CREATE INDEX author_names_surname ON author_names (surname);
+    ''',
+
+    # 6: the distinct first-author surnames, for suggesting corrections to
+    # mistyped ones.
+    '''
+    CREATE TABLE nfas_names (
+           nfas TEXT UNIQUE NOT NULL,
+           npubs INTEGER NOT NULL
+    );
+    INSERT INTO nfas_names (nfas, npubs)
+      SELECT nfas, count(*) FROM pubs WHERE nfas IS NOT NULL GROUP BY nfas;
+    CREATE TRIGGER nfas_names_pubs_insert AFTER INSERT ON pubs
+      WHEN new.nfas IS NOT NULL BEGIN
+      INSERT OR IGNORE INTO nfas_names (nfas, npubs) VALUES (new.nfas, 0);
+      UPDATE nfas_names SET npubs = npubs + 1 WHERE nfas == new.nfas;
+    END;
+    CREATE TRIGGER nfas_names_pubs_delete AFTER DELETE ON pubs
+      WHEN old.nfas IS NOT NULL BEGIN
+      UPDATE nfas_names SET npubs = npubs - 1 WHERE nfas == old.nfas;
+      DELETE FROM nfas_names WHERE nfas == old.nfas AND npubs <= 0;
+    END;
+    CREATE TRIGGER nfas_names_pubs_update AFTER UPDATE OF nfas ON pubs
+      WHEN old.nfas IS NOT new.nfas BEGIN
+      INSERT OR IGNORE INTO nfas_names (nfas, npubs)
+        SELECT new.nfas, 0 WHERE new.nfas IS NOT NULL;
+      UPDATE nfas_names SET npubs = npubs + 1 WHERE nfas == new.nfas;
+      UPDATE nfas_names SET npubs = npubs - 1 WHERE nfas == old.nfas;
+      DELETE FROM nfas_names WHERE nfas == old.nfas AND npubs <= 0;
+    END;
+    ''',
+
+    # 7: identifiers that the web services are known not to know about, so
+    # that we don't keep asking. "expires" is a Unix time.
+    '''
+    CREATE TABLE negcache (
+           kind TEXT NOT NULL,
+           ident TEXT NOT NULL,
+           reason TEXT NOT NULL,
+           expires INTEGER NOT NULL,
+           PRIMARY KEY (kind, ident)
+    );
+    ''',
+
+    # 8: the crosswalk between the bibcodes, DOIs, and arxiv identifiers of
+    # publications, whether or not they're in the database, so that we can
+    # avoid asking ADS about them. Pubs with bibcodes are copied in by
+    # triggers.
+    '''
+    CREATE TABLE crosswalk (
+           bibcode TEXT PRIMARY KEY NOT NULL,
+           doi TEXT,
+           arxiv TEXT
+    );
+    CREATE INDEX crosswalk_doi ON crosswalk (doi);
+    CREATE INDEX crosswalk_arxiv ON crosswalk (arxiv);
+    INSERT INTO crosswalk (bibcode, doi, arxiv)
+      SELECT bibcode, max(doi), max(arxiv) FROM pubs WHERE bibcode IS NOT NULL
+        AND (doi IS NOT NULL OR arxiv IS NOT NULL) GROUP BY bibcode;
+    CREATE TRIGGER crosswalk_pubs_insert AFTER INSERT ON pubs
+      WHEN new.bibcode IS NOT NULL AND (new.doi IS NOT NULL OR new.arxiv IS NOT NULL) BEGIN
+      INSERT INTO crosswalk (bibcode) SELECT new.bibcode
+        WHERE NOT EXISTS (SELECT 1 FROM crosswalk WHERE bibcode == new.bibcode);
+      UPDATE crosswalk SET doi = ifnull(new.doi, doi), arxiv = ifnull(new.arxiv, arxiv)
+        WHERE bibcode == new.bibcode;
+    END;
+    CREATE TRIGGER crosswalk_pubs_update AFTER UPDATE OF bibcode, doi, arxiv ON pubs
+      WHEN new.bibcode IS NOT NULL AND (new.doi IS NOT NULL OR new.arxiv IS NOT NULL) BEGIN
+      INSERT INTO crosswalk (bibcode) SELECT new.bibcode
+        WHERE NOT EXISTS (SELECT 1 FROM crosswalk WHERE bibcode == new.bibcode);
+      UPDATE crosswalk SET doi = ifnull(new.doi, doi), arxiv = ifnull(new.arxiv, arxiv)
+        WHERE bibcode == new.bibcode;
+    END;
+    ''',
+
+    # 9: digests of the records that pubs were last ingested from, so that
+    # "bib ingest --merge" can skip the ones that haven't changed.
+    '''
+    CREATE TABLE pub_hashes (
+           pubid INTEGER PRIMARY KEY NOT NULL,
+           hash TEXT NOT NULL,
+           FOREIGN KEY (pubid) REFERENCES pubs(id)
+    );
+    CREATE INDEX pub_hashes_hash ON pub_hashes (hash);
+    ''',
+
+    # 10: how far ingests of big files have gotten, so that an interrupted
+    # one can pick up where it left off. "hash" is the SHA1 of the first
+    # "offset" bytes of the file, so we can tell if it's been changed.
+    '''
+    CREATE TABLE ingest_checkpoints (
+           path TEXT PRIMARY KEY NOT NULL,
+           offset INTEGER NOT NULL,
+           hash TEXT NOT NULL
+    );
+    ''',
+]
+
+schema_version = len (_migrations)
+
+
+# Optional indexes. These need SQLite features that not every build of the
+# library has, so instead of being migrations, upgrade() creates them
+# whenever the library supports them and they don't exist yet. Each is a
+# virtual table kept in sync by triggers named after it. If we find
+# ourselves on a library that can't maintain one, we drop its triggers so
+# that writes to the database still work, and rebuild it from scratch once a
+# capable library comes back. Some are costly enough that they're only
+# built if a key in the [db] section of the configuration asks for them; if
+# it's turned off again, they're dropped. The code that queries them checks
+# BibDB.has_index() and falls back to scanning.
+
+def _fts_mirror_sql (table, tokenize):
+    """SQL to create a contentless FTS5 index of the searchable text of each pub,
+    populate it, and keep it in sync with triggers. The "refinfo" column
+    holds the identifiers and the refdata JSON, as stored."""
+
+    refinfo = ("ifnull({r}.arxiv, '') || ' ' || ifnull({r}.bibcode, '') || ' ' || "
+               "ifnull({r}.doi, '') || ' ' || ifnull({r}.refdata, '')")
+    new = "new.id, new.title, new.abstract, " + refinfo.format (r='new')
+    old = "'delete', old.id, old.title, old.abstract, " + refinfo.format (r='old')
+
+    return '''
+    CREATE VIRTUAL TABLE {t} USING fts5 (title, abstract, refinfo, content='',
+                                         tokenize='{tokenize}');
+    INSERT INTO {t} (rowid, title, abstract, refinfo)
+      SELECT {p} FROM pubs AS p;
+    CREATE TRIGGER {t}_insert AFTER INSERT ON pubs BEGIN
+      INSERT INTO {t} (rowid, title, abstract, refinfo) VALUES ({new});
+    END;
+    CREATE TRIGGER {t}_delete AFTER DELETE ON pubs BEGIN
+      INSERT INTO {t} ({t}, rowid, title, abstract, refinfo) VALUES ({old});
+    END;
+    CREATE TRIGGER {t}_update
+      AFTER UPDATE OF id, title, abstract, arxiv, bibcode, doi, refdata ON pubs BEGIN
+      INSERT INTO {t} ({t}, rowid, title, abstract, refinfo) VALUES ({old});
+      INSERT INTO {t} (rowid, title, abstract, refinfo) VALUES ({new});
+    END;
+    '''.format (t=table, tokenize=tokenize, new=new, old=old,
+               p="p.id, p.title, p.abstract, " + refinfo.format (r='p'))
+
+
+_nfas_trigram_sql = '''
+    CREATE VIRTUAL TABLE nfas_trigram USING fts5 (nfas, content='nfas_names',
+                                                  tokenize='trigram');
+    INSERT INTO nfas_trigram (nfas_trigram) VALUES ('rebuild');
+    CREATE TRIGGER nfas_trigram_insert AFTER INSERT ON nfas_names BEGIN
+      INSERT INTO nfas_trigram (rowid, nfas) VALUES (new.rowid, new.nfas);
+    END;
+    CREATE TRIGGER nfas_trigram_delete AFTER DELETE ON nfas_names BEGIN
+      INSERT INTO nfas_trigram (nfas_trigram, rowid, nfas) VALUES ('delete', old.rowid, old.nfas);
+    END;
+'''
+
+
+_optional_indexes = [
+    # (name, SQLite features needed, [db] key that enables it or None,
+    #  SQL to create and populate it)
+
+    # word index for "bib grep" and "bib search".
+    ('pubs_fts', ('fts5', ), None, _fts_mirror_sql ('pubs_fts', 'unicode61')),
+
+    # substring index for "bib grep". It holds the same text as pubs_fts
+    # again, so it's about as big, and it slows down ingests noticeably.
+    ('pubs_trigram', ('fts5', 'trigram'), 'substring-index',
+     _fts_mirror_sql ('pubs_trigram', 'trigram')),
+
+    # first-author surnames by trigram, for suggesting corrections.
+    ('nfas_trigram', ('fts5', 'trigram'), None, _nfas_trigram_sql),
+]
+
+
+def sqlite_features (db):
+    """Returns the set of the optional SQLite features that we use that `db`'s
+    library has: "fts5", "trigram" (the FTS5 tokenizer, new in 3.34), and
+    "json1"."""
+
+    def used (option):
+        try:
+            return db.getfirstval ('SELECT sqlite_compileoption_used(?)', option)
+        except sqlite3.OperationalError:
+            return False # compiled without the diagnostics
+
+    version = tuple (int (v) for v in db.getfirstval ('SELECT sqlite_version()').split ('.'))
+    features = set ()
+
+    if used ('ENABLE_FTS5'):
+        features.add ('fts5')
+        if version >= (3, 34):
+            features.add ('trigram')
+
+    # JSON1 became part of the core in 3.38.
+    if used ('ENABLE_JSON1') or (version >= (3, 38) and not used ('OMIT_JSON')):
+        features.add ('json1')
+
+    return features
+
+
+def _configured_optional_indexes (cfg):
+    """Returns the set of the optional indexes that the configuration doesn't
+    rule out."""
+
+    names = set ()
+
+    for name, needs, key, sql in _optional_indexes:
+        if key is None:
+            names.add (name)
+            continue
+
+        if not cfg.has_option ('db', key):
+            continue
+
+        try:
+            if cfg.getboolean ('db', key):
+                names.add (name)
+        except ValueError:
+            die ('configuration key db/%s must be "yes" or "no"; got "%s"',
+                 key, cfg.get ('db', key))
+
+    return names
+
+
+def _update_optional_indexes (db, configured):
+    """Create or disable the optional indexes to suit `db`'s library, and drop
+    any that aren't in the set `configured`. Returns whether any were
+    created."""
+
+    features = sqlite_features (db)
+    existing = dict (db.execute ('SELECT name, type FROM sqlite_master '
+                                 'WHERE type IN (?, ?)', ('table', 'trigger')))
+    created = False
+
+    for name, needs, key, sql in _optional_indexes:
+        usable = all (f in features for f in needs)
+        wanted = usable and name in configured
+        synced = (name + '_insert') in existing
+        # Only a library that can maintain the table can drop it.
+        unwanted = usable and not wanted and name in existing
+        if wanted == synced and not unwanted:
+            continue
+
+        drop = ''.join ('DROP TRIGGER IF EXISTS %s_%s; ' % (name, op)
+                        for op in ('insert', 'delete', 'update'))
+        if wanted:
+            script = drop + 'DROP TABLE IF EXISTS %s; %s' % (name, sql)
+        elif usable:
+            script = drop + 'DROP TABLE IF EXISTS %s' % name
+        else:
+            script = drop
+
+        try:
+            db.executescript ('BEGIN; %s; COMMIT;' % script)
+        except sqlite3.Error as e:
+            try:
+                db.execute ('ROLLBACK')
+            except sqlite3.Error:
+                pass
+            warn ('cannot update the optional index "%s" in "%s": %s', name, dbpath, e)
+            continue
+
+        created = created or wanted
+
+    return created
+
+
+# Stand-ins for the few JSON1 functions that we use, for SQLite builds that
+# lack it. They only understand paths of the form "$.key".
+
+def _json_key (path):
+    if not path.startswith ('$.'):
+        raise ValueError ('unsupported JSON path "%s"' % path)
+    return path[2:]
+
+
+def _json_extract (doc, path):
+    if doc is None:
+        return None
+
+    value = json.loads (doc).get (_json_key (path))
+    if isinstance (value, (dict, list)):
+        return json.dumps (value)
+    return value
+
+
+def _json_setter (replace):
+    def setter (doc, path, value):
+        if doc is None:
+            return None
+
+        d = json.loads (doc)
+        key = _json_key (path)
+        if replace or key not in d:
+            d[key] = value
+        return json.dumps (d)
+
+    return setter
+
+
+def _provide_json_functions (db):
+    db.create_function ('json_extract', 2, _json_extract)
+    db.create_function ('json_insert', 3, _json_setter (False))
+    db.create_function ('json_set', 3, _json_setter (True))
+
+
+def upgrade (db, cfg):
+    """Bring the schema of `db` up to date, in place. Each migration is applied
+    in its own transaction, so an interrupted upgrade can simply be rerun.
+    The optional indexes are then created or disabled to suit the SQLite
+    library and the configuration `cfg`. Databases that haven't been
+    initialized yet are left alone."""
+
+    version = db.getfirstval ('PRAGMA user_version')
+
+    if version > schema_version:
+        die ('the database "%s" has schema version %d, but this version of the '
+             'software only understands up to %d', dbpath, version, schema_version)
+
+    if db.getfirstval ('SELECT count(*) FROM sqlite_master WHERE type == ? '
+                       'AND name == ?', 'table', 'pubs') == 0:
+        return # not initialized.
+
+    db.create_function ('name_to_surname', 1, name_to_surname)
+
+    for i in xrange (version, schema_version):
+        try:
+            db.executescript ('BEGIN; %s; PRAGMA user_version = %d; COMMIT;'
+                              % (_migrations[i], i + 1))
+        except sqlite3.Error as e:
+            try:
+                db.execute ('ROLLBACK')
+            except sqlite3.Error:
+                pass # failed before the transaction began
+            die ('cannot upgrade "%s" to schema version %d: %s', dbpath, i + 1, e)
+
+    created = _update_optional_indexes (db, _configured_optional_indexes (cfg))
+
+    # Give the query planner statistics about the new indexes. Statistics
+    # gathered on a freshly initialized, empty database would only mislead
+    # it, so skip that case.
+    if ((version < schema_version or created) and
+        db.getfirst ('SELECT 1 FROM pubs LIMIT 1') is not None):
+        db.execute ('ANALYZE')
+
+
+class PubRow (object):
+    """A row of the pubs table. Rows can hold any subset of the columns, if
+    they come from a query that only selects some of them; accessing the
+    missing ones raises AttributeError. The refdata JSON is only decoded if
+    someone asks for `refdict`. Listing queries also fill in "nickname",
+    which isn't a column of the table."""
+
+    _fields = tuple ('id abstract arxiv bibcode doi keep nfas refdata title year'.split ())
+    __slots__ = _fields + ('nickname', '_rd')
+
+    def __init__ (self, id, abstract, arxiv, bibcode, doi, keep, nfas, refdata,
+                  title, year):
+        self.id = id
+        self.abstract = abstract
+        self.arxiv = arxiv
+        self.bibcode = bibcode
+        self.doi = doi
+        self.keep = keep
+        self.nfas = nfas
+        self.refdata = refdata
+        self.title = title
+        self.year = year
+
+
+    def __repr__ (self):
+        return 'PubRow(%s)' % ', '.join ('%s=%r' % (f, getattr (self, f))
+                                         for f in self._fields if hasattr (self, f))
+
+
+    @property
+    def refdict (self):
+        """The decoded refdata, or None. This is only decoded once, so copy
+        it before modifying it."""
+
+        try:
+            return self._rd
+        except AttributeError:
+            pass
+
+        rd = self._rd = None if self.refdata is None else json.loads (self.refdata)
+        return rd
+
+
+    def astuple (self):
+        """All of the columns, in table order, as needed for INSERT."""
+        return tuple (getattr (self, f) for f in self._fields)
+
+
+    def _replace (self, **vals):
+        new = PubRow (*self.astuple ())
+        for k, v in vals.iteritems ():
+            setattr (new, k, v)
+        return new
+
+
+_pubrow_cursor_info = [None, None, None]
+
+def _pubrow_factory (cursor, tup):
+    """Row factory for queries on the pubs table. The columns are identified
+    by name, so the query may select any of them in any order. Working out
+    which they are is done once per query."""
+
+    desc = cursor.description
+
+    if desc is not _pubrow_cursor_info[0]:
+        names = tuple (d[0] for d in desc)
+        _pubrow_cursor_info[:] = [desc, names, names == PubRow._fields]
+
+    if _pubrow_cursor_info[2]:
+        return PubRow (*tup)
+
+    row = PubRow.__new__ (PubRow)
+    for name, value in zip (_pubrow_cursor_info[1], tup):
+        setattr (row, name, value)
+    return row
+
 
 AuthorNameRow = collections.namedtuple ('AuthorNameRow',
                                         ['name'])
@@ -60,6 +591,62 @@ PdfRow = collections.namedtuple ('PdfRow',
 authtypes = {'author': 0, 'editor': 1}
 histactions = {'read': 1, 'visit': 2}
 
+# Conservative limit on the number of "?" parameters in one statement; older
+# SQLite builds max out at 999.
+_max_sql_params = 500
+
+
+# How to find the pubs matching each kind of ref in the "temp_pubrefs" table
+# filled in by _fill_temp_pubrefs(). Refs that don't specify a year have a NULL
+# year.
+_pub_ref_conditions = {
+    'arxiv': 'p.arxiv == t.key',
+    'author': ('p.id IN (SELECT a.pubid FROM author_names AS n, authors AS a '
+               'WHERE n.surname == t.key AND a.authid == n.oid) '
+               'AND (t.year IS NULL OR p.year == t.year)'),
+    'bibcode': 'p.bibcode == t.key',
+    'doi': 'p.doi == t.key',
+    'lastlisting': ('p.id IN (SELECT pubid FROM publists '
+                    "WHERE name == 'last_listing' AND idx == t.key)"),
+    'nfasy': 'p.nfas == t.key AND (t.year IS NULL OR p.year == t.year)',
+    'nickname': 'p.id == (SELECT pubid FROM nicknames WHERE nickname == t.key)',
+}
+
+
+# For merging in ingest_pubs(): the pubs that each record in "temp_merge"
+# matches by any of its identifiers, with the hash of the record that they
+# were last ingested from, if known.
+_merge_match_sql = (
+    'SELECT m.idx, m.pubid, h.hash FROM ('
+    '  SELECT t.idx AS idx, p.id AS pubid FROM temp_merge AS t '
+    '    CROSS JOIN pubs AS p WHERE p.doi == t.doi '
+    '  UNION SELECT t.idx, p.id FROM temp_merge AS t '
+    '    CROSS JOIN pubs AS p WHERE p.bibcode == t.bibcode '
+    '  UNION SELECT t.idx, p.id FROM temp_merge AS t '
+    '    CROSS JOIN pubs AS p WHERE p.arxiv == t.arxiv '
+    '  UNION SELECT t.idx, n.pubid FROM temp_merge AS t '
+    '    CROSS JOIN nicknames AS n WHERE n.nickname == t.nickname'
+    ') AS m LEFT JOIN pub_hashes AS h ON h.pubid == m.pubid'
+)
+
+
+def new_ingest_counts ():
+    return dict (new=0, changed=0, unchanged=0, ambiguous=0, skipped=0, renamed=0)
+
+
+def _batches (items, size):
+    batch = []
+
+    for item in items:
+        batch.append (item)
+
+        if len (batch) == size:
+            yield batch
+            batch = []
+
+    if len (batch):
+        yield batch
+
 
 def nt_augment (ntclass, **vals):
     for k in vals.iterkeys ():
@@ -70,6 +657,62 @@ def nt_augment (ntclass, **vals):
 
 
 class BibDB (sqlite3.Connection):
+    # The maximum number of author names whose oids we remember. Check
+    # `authcache_hits` and `authcache_misses` to see how well it's doing.
+    author_cache_size = 16384
+
+    # The columns that print_generic_listing() needs, for selecting from the
+    # pubs table aliased as "p". The nickname is the one that
+    # choose_pub_nickname() would pick.
+    listing_columns = ('p.id, p.nfas, p.year, p.title, '
+                       '(SELECT nickname FROM nicknames WHERE pubid == p.id '
+                       ' ORDER BY length(nickname) ASC LIMIT 1) AS nickname')
+
+    def __init__ (self, *args, **kwargs):
+        super (BibDB, self).__init__ (*args, **kwargs)
+        self._authcache = collections.OrderedDict ()
+        self._temp_tables = set ()
+        self.authcache_hits = 0
+        self.authcache_misses = 0
+        self._settled_changes = 0
+
+
+    def commit (self):
+        super (BibDB, self).commit ()
+        self._settled_changes = self.total_changes
+
+
+    def rollback (self):
+        # Names that we inserted during this transaction are going away, and
+        # we don't track which those are, so the whole cache must go.
+        super (BibDB, self).rollback ()
+        self._authcache.clear ()
+        self._settled_changes = self.total_changes
+
+
+    def executescript (self, script):
+        # This commits first, as do the scripts that we run.
+        c = super (BibDB, self).executescript (script)
+        self._settled_changes = self.total_changes
+        return c
+
+
+    @property
+    def in_transaction (self):
+        """Whether there are changes that haven't been committed yet. Python 2's
+        sqlite3 module doesn't tell us, so we compare the number of rows
+        changed so far with the number at the last commit or rollback. A
+        transaction in which no rows have changed yet doesn't count, but
+        there's nothing in it to lose."""
+        return self.total_changes != self._settled_changes
+
+
+    def has_index (self, name):
+        """Whether the optional index `name`, such as "pubs_fts", is available."""
+        return self.getfirstval ('SELECT count(*) FROM sqlite_master WHERE type == ? '
+                                 'AND name == ?', 'trigger', name + '_insert') > 0
+
+
     def getfirst (self, fmt, *args):
         """Returns the tuple from sqlite3, or None."""
         return self.execute (fmt, args).fetchone ()
@@ -86,7 +729,7 @@ class BibDB (sqlite3.Connection):
 
     def pub_fquery (self, q, *args):
         c = self.cursor ()
-        c.row_factory = lambda curs, tup: PubRow (*tup)
+        c.row_factory = _pubrow_factory
         return c.execute (q, args)
 
 
@@ -94,18 +737,55 @@ class BibDB (sqlite3.Connection):
         return self.pub_fquery ('SELECT * FROM pubs WHERE ' + partial, *args)
 
 
-    def learn_pub_authors (self, pubid, authtype, authors):
-        authtype = authtypes[authtype]
+    def _author_name_ids (self, names):
+        """Returns a dict mapping each of `names` to its oid in the
+        author_names table, adding any names that aren't there yet. Names are
+        interned in an in-memory LRU cache, and the ones that miss it are
+        handled with a few bulk statements rather than a round trip per
+        name."""
+
+        cache = self._authcache
+        ids = {}
+        missing = []
+
+        for name in set (names):
+            oid = cache.pop (name, None)
+            if oid is None:
+                missing.append (name)
+            else:
+                cache[name] = oid # re-insert to mark as most recently used
+                ids[name] = oid
+
+        self.authcache_hits += len (ids)
+        self.authcache_misses += len (missing)
+
+        if not len (missing):
+            return ids
+
         c = self.cursor ()
+        c.executemany ('INSERT OR IGNORE INTO author_names (name, surname) VALUES (?, ?)',
+                       ((n, name_to_surname (n)) for n in missing))
+
+        for i in xrange (0, len (missing), _max_sql_params):
+            chunk = missing[i:i+_max_sql_params]
+            c.execute ('SELECT name, oid FROM author_names WHERE name IN (%s)'
+                       % ','.join ('?' * len (chunk)), chunk)
 
-        for idx, auth in enumerate (authors):
-            # Based on reading StackExchange, there's no cleaner way to do this,
-            # but the SELECT should be snappy.
-            c.execute ('INSERT OR IGNORE INTO author_names VALUES (?)',
-                       (auth, ))
-            row = self.getfirst ('SELECT oid FROM author_names WHERE name = ?', auth)[0]
-            c.execute ('INSERT OR REPLACE INTO authors VALUES (?, ?, ?, ?)',
-                       (authtype, pubid, idx, row))
+            for name, oid in c:
+                ids[name] = cache[name] = oid
+
+        while len (cache) > self.author_cache_size:
+            cache.popitem (last=False)
+
+        return ids
+
+
+    def learn_pub_authors (self, pubid, authtype, authors):
+        authtype = authtypes[authtype]
+        ids = self._author_name_ids (authors)
+        self.executemany ('INSERT OR REPLACE INTO authors VALUES (?, ?, ?, ?)',
+                          ((authtype, pubid, idx, ids[auth])
+                           for idx, auth in enumerate (authors)))
 
 
     def get_pub_authors (self, pubid, authtype='author'):
@@ -118,6 +798,116 @@ class BibDB (sqlite3.Connection):
                               'ORDER BY idx', (authtype, pubid, )))
 
 
+    def _make_temp_table (self, name, decl):
+        if name in self._temp_tables:
+            return
+
+        # Only do this once: outside of a transaction, Python's sqlite3
+        # commits before DDL statements, which resets any cursors that our
+        # callers might be iterating over.
+        self.execute ('CREATE TEMP TABLE IF NOT EXISTS %s (%s)' % (name, decl))
+        self._temp_tables.add (name)
+        self._settled_changes = self.total_changes
+
+
+    def _fill_temp_pubids (self, pubids):
+        """Load `pubids` into the temporary table "temp_pubids", replacing its
+        previous contents, so that they can be joined against."""
+
+        self._make_temp_table ('temp_pubids', 'id INTEGER PRIMARY KEY')
+        self.execute ('DELETE FROM temp_pubids')
+        self.executemany ('INSERT OR IGNORE INTO temp_pubids VALUES (?)',
+                          ((i, ) for i in pubids))
+
+
+    def _fill_temp_pubrefs (self, refs):
+        """Load `refs` into the temporary table "temp_pubrefs", replacing its
+        previous contents, with their indices in the list. Nones are left
+        out."""
+
+        self._make_temp_table ('temp_pubrefs', 'idx INTEGER PRIMARY KEY, kind, key, year')
+        self.execute ('DELETE FROM temp_pubrefs')
+        self.executemany ('INSERT INTO temp_pubrefs VALUES (?, ?, ?, ?)',
+                          ((i, ) + tuple (r) for i, r in enumerate (refs)
+                           if r is not None))
+
+
+    def get_pubs_by_ids (self, pubids, columns='p.*'):
+        """Returns a dict mapping each of `pubids` that exists to its PubRow,
+        fetched with one query. `columns` is the list of columns to select
+        from the pubs table, which is aliased as "p"; it must include the
+        id."""
+
+        self._fill_temp_pubids (pubids)
+        return dict ((pub.id, pub) for pub in self.pub_fquery (
+            'SELECT ' + columns + ' FROM temp_pubids AS tp CROSS JOIN pubs AS p '
+            'WHERE p.id == tp.id'))
+
+
+    def resolve_pub_refs (self, refs):
+        """Find the pubs referred to by many identifiers at once. `refs` is a
+        list of (kind, key, year) tuples as returned by
+        BibApp.parse_pub_ref(), or Nones, which match nothing. Returns a list
+        of lists of the matching pub IDs, one list for each ref. This takes
+        one query per kind of ref, however many refs there are."""
+
+        self._fill_temp_pubrefs (refs)
+        results = [[] for r in refs]
+
+        # The CROSS JOINs make SQLite use the (small) table of refs as the
+        # outer loop, even though it has no statistics for it.
+        for kind in set (r[0] for r in refs if r is not None):
+            for idx, pubid in self.execute ('SELECT t.idx, p.id FROM temp_pubrefs AS t '
+                                            'CROSS JOIN pubs AS p WHERE t.kind == ? AND ' +
+                                            _pub_ref_conditions[kind], (kind, )):
+                results[idx].append (pubid)
+
+        return results
+
+
+    def pub_refs_query (self, refs, columns='p.*'):
+        """Returns SQL selecting `columns` from the pubs referred to by `refs`,
+        which are as in resolve_pub_refs(). Each pub comes once, in the order
+        of the first ref to it. It's one join however many refs there are,
+        so it can be sorted and paged by the database. The refs are kept in
+        the same temporary table as resolve_pub_refs() uses, so run the query
+        before calling either again."""
+
+        self._fill_temp_pubrefs (refs)
+        conds = ' OR '.join ("(t.kind == '%s' AND %s)" % (kind, _pub_ref_conditions[kind])
+                             for kind in sorted (set (r[0] for r in refs if r is not None)))
+
+        return ('SELECT ' + columns + ' FROM temp_pubrefs AS t CROSS JOIN pubs AS p '
+                'WHERE ' + (conds or '0') + ' GROUP BY p.id ORDER BY min(t.idx)')
+
+
+    def get_authors_for_pubs (self, pubids, types=('author', 'editor')):
+        """Returns a dict mapping each of `pubids` to a dict mapping each of
+        `types` to a list of parsed names, in order. This is done with one
+        query, so use this rather than get_pub_authors() when dealing with
+        lots of pubs."""
+
+        pubids = list (pubids)
+        result = dict ((pubid, dict ((t, []) for t in types)) for pubid in pubids)
+
+        if not len (pubids):
+            return result
+
+        typenames = dict ((authtypes[t], t) for t in types)
+        self._fill_temp_pubids (pubids)
+
+        for pubid, authtype, name in self.execute (
+                'SELECT au.pubid, au.type, an.name '
+                'FROM temp_pubids AS tp, authors AS au, author_names AS an '
+                'WHERE au.pubid == tp.id AND au.authid == an.oid '
+                '  AND au.type IN (%s) '
+                'ORDER BY au.pubid, au.type, au.idx' % ','.join ('?' * len (typenames)),
+                typenames.keys ()):
+            result[pubid][typenames[authtype]].append (parse_name (name))
+
+        return result
+
+
     def get_pub_fas (self, pubid):
         """FAS = first-author surname. May return None. We specifically are retrieving
         the un-normalized version here, so we don't use the value stored in
@@ -152,15 +942,13 @@ class BibDB (sqlite3.Connection):
             warn ('useless "ArXiv e-prints" bibliographical record')
 
 
-    def _fill_pub (self, info, pubid):
-        """Note that `info` will be mutated.
-
-        If pubid is None, a new record will be created; otherwise it will
-        be updated."""
+    def _prep_pub (self, info):
+        """Note that `info` will be mutated. Returns a tuple of (row, authors,
+        editors, nicknames), where the row's id is whatever `info` said."""
 
-        authors = info.pop ('authors', ())
-        editors = info.pop ('editors', ())
-        nicknames = info.pop ('nicknames', ())
+        authors = info.pop ('authors', None) or ()
+        editors = info.pop ('editors', None) or ()
+        nicknames = info.pop ('nicknames', None) or ()
 
         if 'abstract' in info:
             info['abstract'] = squish_spaces (info['abstract'])
@@ -174,16 +962,33 @@ class BibDB (sqlite3.Connection):
             self._lint_refdata (info)
             info['refdata'] = json.dumps (info['refdata'])
 
-        row = nt_augment (PubRow, **info)
+        return nt_augment (PubRow, **info), authors, editors, nicknames
+
+
+    def _fill_pub (self, info, pubid):
+        """Note that `info` will be mutated.
+
+        If pubid is None, a new record will be created; otherwise it will
+        be updated."""
+
+        return self._write_pub (pubid, *self._prep_pub (info))
+
+
+    def _write_pub (self, pubid, row, authors, editors, nicknames):
+        """Write out a pub from the parts returned by _prep_pub(), as with
+        _fill_pub(). When updating, the pub's authors and nicknames should be
+        cleared first, or at least those that `nicknames` repeats."""
+
         c = self.cursor ()
 
         if pubid is not None:
             # not elegant but as far as I can tell there's no alternative.
             c.execute ('UPDATE pubs SET abstract=?, arxiv=?, bibcode=?, '
                        '  doi=?, keep=?, nfas=?, refdata=?, title=?, year=? '
-                       'WHERE id == ?', row[1:] + (pubid, ))
+                       'WHERE id == ?', row.astuple ()[1:] + (pubid, ))
         else:
-            c.execute ('INSERT INTO pubs VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)', row)
+            c.execute ('INSERT INTO pubs VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                       row.astuple ())
             pubid = c.lastrowid
 
         if authors:
@@ -200,9 +1005,7 @@ class BibDB (sqlite3.Connection):
                 except sqlite3.IntegrityError:
                     die ('duplicated pub nickname "%s"', nickname)
 
-        tmp = list (row)
-        tmp[0] = pubid
-        return PubRow (*tmp)
+        return row._replace (id=pubid)
 
 
     def learn_pub (self, info):
@@ -210,6 +1013,352 @@ class BibDB (sqlite3.Connection):
         return self._fill_pub (info, None)
 
 
+    learn_batch_size = 2000
+    conflict_policies = ('fail', 'skip', 'rename')
+
+    def learn_pubs (self, infos, conflicts='fail'):
+        """Learn many new publications at once. `infos` may be any iterable of
+        info dicts, as taken by learn_pub(); they will be mutated. They are
+        passed to ingest_pubs() in batches of `learn_batch_size`, so that a
+        failure only rolls back the batch that it occurred in. Returns the
+        number of publications learned."""
+
+        counts = new_ingest_counts ()
+
+        for batch in _batches (infos, self.learn_batch_size):
+            self.ingest_pubs (batch, conflicts=conflicts, counts=counts)
+
+        return counts['new']
+
+
+    def merge_pubs (self, infos, conflicts='fail'):
+        """Like learn_pubs(), but for bringing the database up to date with a
+        source of records that it has seen before; see ingest_pubs(). Returns
+        the counts from it."""
+
+        counts = new_ingest_counts ()
+        claimed = set ()
+
+        for batch in _batches (infos, self.learn_batch_size):
+            self.ingest_pubs (batch, merge=True, conflicts=conflicts, counts=counts,
+                              claimed=claimed)
+
+        return counts
+
+
+    def ingest_pubs (self, infos, merge=False, conflicts='fail', checkpoint=None,
+                     counts=None, claimed=None):
+        """Learn a batch of new publications in one transaction, with bulk
+        statements. `infos` is a list of info dicts, as taken by learn_pub();
+        they will be mutated. An info may also have a "srchash" item, a digest
+        of the record that it came from, which is remembered for merging. The
+        batch is committed, so this raises sqlite3.ProgrammingError if the
+        caller has uncommitted changes, rather than committing those too.
+
+        If `merge`, records that match a pub by DOI, bibcode, arxiv
+        identifier, or nickname update it in place, unless their "srchash" is
+        that of the record that it was last ingested from, in which case
+        nothing is written. Records that match more than one pub are skipped
+        with a warning. The batch is matched with one query. `claimed` is a
+        set of the IDs of the pubs that earlier records of the same ingest
+        matched, which is added to. A record that matches one of those is
+        ambiguous too: "fail" (see below) dies, and the other policies skip
+        it with a warning, so that the first record for a pub always wins.
+
+        A changed record's nicknames are added to those that the pub already
+        has, so that ones given to it by hand aren't lost. `conflicts` says
+        what to do with a record that brings a nickname that's already taken
+        by another pub: "fail" dies, "skip" skips the record with a warning,
+        and "rename" gives it the first free nickname with a suffix of "-2",
+        "-3", and so on. If `checkpoint` is given, it's a tuple of (path,
+        offset, hash) to save as by set_ingest_checkpoint() in the same
+        transaction.
+
+        Returns `counts`, a dict from new_ingest_counts(), after adding the
+        numbers of records that were "new", "changed", "unchanged",
+        "ambiguous", "skipped", and "renamed" (which are also new or
+        changed)."""
+
+        if conflicts not in self.conflict_policies:
+            raise ValueError ('unknown conflict policy "%s"' % conflicts)
+
+        if counts is None:
+            counts = new_ingest_counts ()
+
+        if self.in_transaction:
+            raise sqlite3.ProgrammingError ('cannot ingest publications with uncommitted '
+                                            'changes pending')
+
+        try:
+            if merge:
+                self._merge_batch (infos, conflicts, counts,
+                                   set () if claimed is None else claimed)
+            else:
+                hashes = [info.pop ('srchash', None) for info in infos]
+                batch = [self._prep_pub (info) for info in infos]
+                batch, hashes = self._resolve_nicknames (batch, hashes, conflicts, counts)
+                self._insert_batch (batch, hashes, counts)
+
+            if checkpoint is not None:
+                self.set_ingest_checkpoint (*checkpoint)
+        except:
+            self.rollback ()
+            raise
+
+        self.commit ()
+        return counts
+
+
+    def _free_nickname (self, nickname, taken):
+        for i in itertools.count (2):
+            candidate = '%s-%d' % (nickname, i)
+
+            if candidate in taken:
+                continue
+            if self.getfirstval ('SELECT count(*) FROM nicknames WHERE nickname == ?',
+                                 candidate) == 0:
+                return candidate
+
+
+    def _resolve_nicknames (self, batch, extras, conflicts, counts):
+        """Deal with the nicknames in `batch`, a list of tuples from _prep_pub(),
+        that are already taken, by other pubs or earlier in the batch, as
+        described in ingest_pubs(). `extras` is a list of anything, one item
+        for each record. Returns the batch and `extras` without any skipped
+        records."""
+
+        # Check nicknames up front, since we can't tell which row of an
+        # executemany() violated a constraint.
+        nicknames = [n for t in batch for n in t[3]]
+        taken = set ()
+
+        for i in xrange (0, len (nicknames), _max_sql_params):
+            chunk = nicknames[i:i+_max_sql_params]
+            taken.update (n for n, in self.execute ('SELECT nickname FROM nicknames WHERE '
+                                                    'nickname IN (%s)' % ','.join ('?' * len (chunk)),
+                                                    chunk))
+
+        keptbatch = []
+        keptextras = []
+
+        for t, extra in zip (batch, extras):
+            nicknames = []
+
+            for nickname in t[3]:
+                if nickname not in taken:
+                    nicknames.append (nickname)
+                    taken.add (nickname)
+                    continue
+
+                if conflicts == 'fail':
+                    die ('duplicated pub nickname "%s"', nickname)
+
+                if conflicts == 'skip':
+                    warn ('skipping a record with the duplicated nickname "%s"', nickname)
+                    counts['skipped'] += 1
+                    nicknames = None
+                    break
+
+                renamed = self._free_nickname (nickname, taken)
+                warn ('duplicated pub nickname "%s"; calling it "%s" instead',
+                      nickname, renamed)
+                nicknames.append (renamed)
+                taken.add (renamed)
+
+            if nicknames is None:
+                continue
+
+            if nicknames != list (t[3]):
+                counts['renamed'] += 1
+                t = t[:3] + (nicknames, )
+
+            keptbatch.append (t)
+            keptextras.append (extra)
+
+        return keptbatch, keptextras
+
+
+    def _insert_batch (self, batch, hashes, counts):
+        """Insert new pubs. `batch` is a list of tuples from _prep_pub(), whose
+        nicknames have been through _resolve_nicknames(), and `hashes` the
+        digests of their source records, or Nones. Doesn't commit."""
+
+        if not len (batch):
+            return
+
+        # Allocate IDs ourselves so that we can use executemany(). This
+        # matches what SQLite does for rowids; if another process sneaks
+        # in a pub, we'll get an IntegrityError and roll back.
+        c = self.cursor ()
+        nextid = self.getfirstval ('SELECT ifnull(max(id), 0) + 1 FROM pubs')
+        pubids = range (nextid, nextid + len (batch))
+
+        c.executemany ('INSERT INTO pubs VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                       ((pubid, ) + row.astuple ()[1:]
+                        for pubid, (row, _, _, _) in zip (pubids, batch)))
+
+        nameids = self._author_name_ids (name for t in batch
+                                         for names in t[1:3]
+                                         for name in names)
+        authrows = []
+
+        for pubid, (_, authors, editors, _) in zip (pubids, batch):
+            for authtype, names in (('author', authors), ('editor', editors)):
+                authtype = authtypes[authtype]
+                authrows.extend ((authtype, pubid, idx, nameids[name])
+                                 for idx, name in enumerate (names))
+
+        c.executemany ('INSERT INTO authors VALUES (?, ?, ?, ?)', authrows)
+        c.executemany ('INSERT INTO nicknames VALUES (?, ?)',
+                       ((nickname, pubid)
+                        for pubid, t in zip (pubids, batch)
+                        for nickname in t[3]))
+        c.executemany ('INSERT OR REPLACE INTO pub_hashes VALUES (?, ?)',
+                       ((pubid, h) for pubid, h in zip (pubids, hashes)
+                        if h is not None))
+
+        counts['new'] += len (batch)
+
+
+    def known_pub_hashes (self, hashes):
+        """Returns a dict mapping those of `hashes` that are the "srchash"es of
+        pubs in the database to lists of the IDs of those pubs. Callers can
+        use this to skip unchanged records before going to the trouble of
+        parsing them."""
+
+        known = collections.defaultdict (list)
+
+        for i in xrange (0, len (hashes), _max_sql_params):
+            chunk = hashes[i:i+_max_sql_params]
+            for h, pubid in self.execute ('SELECT hash, pubid FROM pub_hashes WHERE '
+                                          'hash IN (%s)' % ','.join ('?' * len (chunk)),
+                                          chunk):
+                known[h].append (pubid)
+
+        return dict (known)
+
+
+    def _merge_batch (self, infos, conflicts, counts, claimed):
+        self._make_temp_table ('temp_merge', 'idx INTEGER, doi TEXT, bibcode TEXT, '
+                               'arxiv TEXT, nickname TEXT')
+        self.execute ('DELETE FROM temp_merge')
+        self.executemany ('INSERT INTO temp_merge VALUES (?, ?, ?, ?, ?)',
+                          ((idx, info.get ('doi'), info.get ('bibcode'), info.get ('arxiv'),
+                            nickname)
+                           for idx, info in enumerate (infos)
+                           for nickname in (info.get ('nicknames') or (None, ))))
+
+        matches = [{} for info in infos]
+        for idx, pubid, oldhash in self.execute (_merge_match_sql):
+            matches[idx][pubid] = oldhash
+
+        records = [] # (info, pubid or None, srchash)
+
+        for info, match in zip (infos, matches):
+            newhash = info.pop ('srchash', None)
+
+            if not len (match):
+                records.append ((info, None, newhash))
+                continue
+
+            ident = ((info.get ('nicknames') or [None])[0] or info.get ('doi') or
+                     info.get ('bibcode') or info.get ('arxiv'))
+
+            if len (match) > 1:
+                warn ('record "%s" matches %d different publications; skipping it',
+                      ident, len (match))
+                counts['ambiguous'] += 1
+                continue
+
+            pubid, oldhash = match.items ()[0]
+
+            if pubid in claimed:
+                # Otherwise the records would take turns overwriting the pub,
+                # one on each merge.
+                if conflicts == 'fail':
+                    die ('record "%s" matches the same publication as an earlier record',
+                         ident)
+                warn ('record "%s" matches the same publication as an earlier record; '
+                      'skipping it', ident)
+                counts['ambiguous'] += 1
+                continue
+
+            claimed.add (pubid)
+
+            if newhash is not None and oldhash == newhash:
+                counts['unchanged'] += 1
+            else:
+                records.append ((info, pubid, newhash))
+
+        # Changed records keep their pubs' "keep" flags and nicknames; only
+        # the nicknames that they add need to be checked.
+        changedids = [pubid for info, pubid, h in records if pubid is not None]
+        keeps = {}
+        nicknames = collections.defaultdict (set)
+
+        if len (changedids):
+            keeps = dict ((pub.id, pub.keep) for pub in
+                          self.get_pubs_by_ids (changedids, 'p.id, p.keep').itervalues ())
+            for pubid, nickname in self.execute ('SELECT n.pubid, n.nickname FROM temp_pubids AS tp '
+                                                 'CROSS JOIN nicknames AS n WHERE n.pubid == tp.id'):
+                nicknames[pubid].add (nickname)
+
+        batch = []
+
+        for info, pubid, h in records:
+            if pubid is not None:
+                info['keep'] = keeps[pubid]
+
+            t = self._prep_pub (info)
+
+            if pubid is not None:
+                t = t[:3] + ([n for n in t[3] if n not in nicknames[pubid]], )
+
+            batch.append (t)
+
+        extras = [(pubid, h) for info, pubid, h in records]
+        batch, extras = self._resolve_nicknames (batch, extras, conflicts, counts)
+        new = []
+        newhashes = []
+
+        for t, (pubid, h) in zip (batch, extras):
+            if pubid is None:
+                new.append (t)
+                newhashes.append (h)
+                continue
+
+            self.execute ('DELETE FROM authors WHERE pubid == ?', (pubid, ))
+            self._write_pub (pubid, *t)
+            if h is not None:
+                self.execute ('INSERT OR REPLACE INTO pub_hashes VALUES (?, ?)', (pubid, h))
+            counts['changed'] += 1
+
+        self._insert_batch (new, newhashes, counts)
+
+
+    def get_ingest_checkpoint (self, path):
+        """Returns (offset, hash) saying how far an unfinished ingest of the file
+        `path` got, or None."""
+
+        for row in self.execute ('SELECT offset, hash FROM ingest_checkpoints '
+                                 'WHERE path == ?', (path, )):
+            return tuple (row)
+        return None
+
+
+    def set_ingest_checkpoint (self, path, offset, hash):
+        """Record that the records in the first `offset` bytes of the file `path`,
+        whose SHA1 is `hash`, have been ingested. Doesn't commit."""
+
+        self.execute ('INSERT OR REPLACE INTO ingest_checkpoints VALUES (?, ?, ?)',
+                      (path, offset, hash))
+
+
+    def clear_ingest_checkpoint (self, path):
+        self.execute ('DELETE FROM ingest_checkpoints WHERE path == ?', (path, ))
+        self.commit ()
+
+
     def update_pub (self, pub, info):
         info['keep'] = pub.keep
 
@@ -232,11 +1381,110 @@ class BibDB (sqlite3.Connection):
         self.execute ('DELETE FROM nicknames WHERE pubid == ?', (pubid, ))
         self.execute ('DELETE FROM notes WHERE pubid == ?', (pubid, ))
         self.execute ('DELETE FROM pdfs WHERE pubid == ?', (pubid, ))
+        self.execute ('DELETE FROM pub_hashes WHERE pubid == ?', (pubid, ))
         self.execute ('DELETE FROM publists WHERE pubid == ?', (pubid, ))
         self.execute ('DELETE FROM pubs WHERE id == ?', (pubid, ))
 
         # at some point the author_names table will need rebuilding, but
-        # I don't think we should worry about that here.
+        # I don't think we should worry about that here. Since we leave it
+        # alone, the oids interned in _authcache stay valid.
+
+
+    def canonicalize_journal (self, oldjournal, newjournal, newissn=None,
+                              dryrun=False):
+        """Rename the journal `oldjournal` to `newjournal` in the refdata of every
+        pub, also setting the ISSN to `newissn` where none is recorded. Only the
+        matching rows are touched, found through the refkeys index. Returns the
+        number of affected pubs; if `dryrun`, nothing is actually changed."""
+
+        if dryrun:
+            return self.getfirstval ('SELECT count(*) FROM refkeys WHERE journal == ?',
+                                     oldjournal)
+
+        if newissn is None:
+            newrd = 'json_set(refdata, \'$.journal\', ?)'
+            args = (newjournal, oldjournal)
+        else:
+            newrd = 'json_set(json_insert(refdata, \'$.issn\', ?), \'$.journal\', ?)'
+            args = (newissn, newjournal, oldjournal)
+
+        c = self.cursor ()
+        c.execute ('UPDATE pubs SET refdata = ' + newrd + ' WHERE id IN '
+                   '(SELECT pubid FROM refkeys WHERE journal == ?)', args)
+        return c.rowcount
+
+
+    def negcache_lookup (self, kind, ident):
+        """Returns the reason that looking up the identifier `ident` of type `kind`
+        on the web failed, or None if we don't know of a failure that hasn't
+        expired yet."""
+
+        import time
+        return self.getfirstval ('SELECT reason FROM negcache WHERE kind == ? AND '
+                                 'ident == ? AND expires > ?', kind, ident,
+                                 int (time.time ()))
+
+
+    def negcache_add (self, entries, ttl):
+        """Remember the failures in `entries`, an iterable of (kind, ident, reason),
+        for `ttl` seconds. Expired entries are cleared out while we're at it."""
+
+        import time
+        now = int (time.time ())
+        self.execute ('DELETE FROM negcache WHERE expires <= ?', (now, ))
+        self.executemany ('INSERT OR REPLACE INTO negcache VALUES (?, ?, ?, ?)',
+                          ((kind, ident, reason, now + ttl)
+                           for kind, ident, reason in entries))
+
+
+    def negcache_purge (self, kind=None, ident=None, expired=False):
+        """Forget failures: all of them, or only those for `ident` (of any kind,
+        unless `kind` is given), or only expired ones. Returns the number of
+        entries forgotten."""
+
+        import time
+        conds = []
+        args = []
+
+        if kind is not None:
+            conds.append ('kind == ?')
+            args.append (kind)
+        if ident is not None:
+            conds.append ('ident == ?')
+            args.append (ident)
+        if expired:
+            conds.append ('expires <= ?')
+            args.append (int (time.time ()))
+
+        sql = 'DELETE FROM negcache'
+        if len (conds):
+            sql += ' WHERE ' + ' AND '.join (conds)
+
+        c = self.cursor ()
+        c.execute (sql, args)
+        return c.rowcount
+
+
+    def crosswalk_bibcode (self, kind, ident):
+        """Returns the bibcode of the publication with the DOI or arxiv identifier
+        `ident`, if the crosswalk knows it, or None."""
+
+        if kind not in ('arxiv', 'doi'):
+            raise ValueError ('cannot look up bibcodes by "%s"' % kind)
+
+        return self.getfirstval ('SELECT bibcode FROM crosswalk WHERE %s == ?' % kind, ident)
+
+
+    def crosswalk_add (self, entries):
+        """Add `entries`, an iterable of (bibcode, doi, arxiv) tuples, to the
+        crosswalk. Null identifiers don't replace known ones."""
+
+        c = self.cursor ()
+
+        for bibcode, doi, arxiv in entries:
+            c.execute ('INSERT OR IGNORE INTO crosswalk (bibcode) VALUES (?)', (bibcode, ))
+            c.execute ('UPDATE crosswalk SET doi = ifnull(?, doi), arxiv = ifnull(?, arxiv) '
+                       'WHERE bibcode == ?', (doi, arxiv, bibcode))
 
 
     def log_action (self, pubid, actionid):
@@ -0,0 +1,186 @@
+# -*- mode: python; coding: utf-8 -*-
+# Copyright 2015 Peter Williams <peter@newton.cx>
+# Licensed under the GNU General Public License, version 3 or higher.
+
+"""
+Full-text searching of the database.
+
+The "pubs_fts" table is an FTS5 word index over each publication's title,
+abstract, and "refinfo", which is its identifiers and refdata JSON mashed
+together. "pubs_trigram" indexes the same text by trigrams, so it can find
+arbitrary substrings of three or more characters; since it's costly, it only
+exists if the "substring-index" key of the [db] configuration section is
+turned on. Both are maintained by triggers on the pubs table.
+
+Word queries are answered straight from the word index. Regular expressions
+can't be, but any match of a regex has to contain certain literal strings. We
+look those up in the trigram index if they're long enough, or turn them into
+a word query otherwise, to find a superset of the matching publications. Then
+we only have to run the regex on those candidates.
+
+The indexes are optional, since they need SQLite features that some builds
+lack. Without them, we run the regex on every publication.
+
+"""
+
+from __future__ import absolute_import, division, print_function, unicode_literals
+import re
+
+from .util import *
+
+__all__ = ('grep_pubs required_literals').split ()
+
+
+def required_literals (regex, flags=0):
+    """Returns a list of strings that must appear in any match of `regex`. Each
+    item is a tuple (text, leftbound, rightbound), where the flags say whether
+    the text is known to start or end at the beginning or end of the searched
+    string. We just look at the top level of the pattern; that's enough to be
+    useful, and it's easy to see that it's correct."""
+
+    import sre_constants as C, sre_parse
+
+    anchors = (C.AT_BEGINNING, C.AT_BEGINNING_STRING, C.AT_END, C.AT_END_STRING)
+    lits = []
+    cur = []
+    leftbound = False
+
+    for op, av in sre_parse.parse (regex, flags):
+        if op == C.LITERAL:
+            cur.append (unichr (av))
+            continue
+
+        anchored = (op == C.AT and av in anchors)
+
+        if len (cur):
+            lits.append ((''.join (cur), leftbound, anchored))
+            cur = []
+
+        leftbound = anchored
+
+    if len (cur):
+        lits.append ((''.join (cur), leftbound, False))
+
+    return lits
+
+
+def _is_token_char (c):
+    # This matches the default character classes of FTS5's unicode61
+    # tokenizer: everything else separates tokens.
+    from unicodedata import category
+    cat = category (c)
+    return cat[0] in 'LN' or cat == 'Co'
+
+
+def _literal_phrase (text, leftbound, rightbound):
+    """Returns an FTS5 phrase that must match any text containing `text`, or None if
+    we can't come up with one.
+
+    If a run of word characters in `text` is delimited by separators on both
+    sides, it must be a complete token of the searched text, so we can look
+    for it in the index. If it's only delimited on the left, it's a prefix of
+    a token. If it's not delimited on the left, we can't say anything useful
+    about it."""
+
+    tokens = []
+    prefix = False
+    start = None
+
+    for i in xrange (len (text) + 1):
+        if i < len (text) and _is_token_char (text[i]):
+            if start is None:
+                start = i
+            continue
+
+        if start is None:
+            continue
+
+        if start > 0 or leftbound:
+            tokens.append (text[start:i])
+            prefix = not (i < len (text) or rightbound)
+        start = None
+
+    if prefix and len (tokens[-1]) < 3:
+        # Such a short prefix would barely narrow things down.
+        tokens.pop ()
+        prefix = False
+
+    if not len (tokens):
+        return None
+
+    return '"' + ' '.join (tokens) + '"' + ('*' if prefix else '')
+
+
+def grep_pubs (db, pattern, fixed=False, nocase=False, refinfo=False, words=False,
+               columns='p.*'):
+    """Search the titles and abstracts of the publications in the database, or their
+    identifiers and reference info if `refinfo` is true. By default `pattern` is
+    a regular expression; if `fixed`, it's a plain string; and if `words`, it's
+    an FTS5 query expression. Returns an iterable of PubRows; word queries come
+    out in order of relevance. `columns` is the list of columns to select
+    from the pubs table, which is aliased as "p"."""
+
+    if isinstance (pattern, bytes):
+        pattern = pattern.decode ('utf-8')
+
+    if refinfo:
+        fields = ['arxiv', 'bibcode', 'doi', 'refdata']
+        ftscols = 'refinfo'
+    else:
+        fields = ['title', 'abstract']
+        ftscols = '{title abstract}'
+
+    def ftsquery (table, extra, ftsexpr):
+        # bm25 weights go by column: title, abstract, refinfo
+        return db.pub_fquery ('SELECT {c} FROM {t}, pubs AS p '
+                              'WHERE {t} MATCH ? AND p.id == {t}.rowid {x}'
+                              'ORDER BY bm25({t}, 10.0, 1.0, 1.0)'.format (c=columns, t=table,
+                                                                            x=extra),
+                              '%s : (%s)' % (ftscols, ftsexpr))
+
+    have_words = db.has_index ('pubs_fts')
+
+    if words:
+        if not have_words:
+            die ('word searches need an SQLite library with FTS5 support')
+        return ftsquery ('pubs_fts', '', pattern)
+
+    if fixed:
+        literals = [(pattern, False, False)]
+
+        def rmatch (i):
+            if i is None:
+                return False
+            return pattern in i
+    else:
+        flags = re.UNICODE
+
+        if nocase:
+            flags |= re.IGNORECASE
+
+        # Could use the Sqlite REGEXP machinery, but it should be somewhat
+        # faster to precompile the regex. Premature optimization FTW.
+        comp = re.compile (pattern, flags)
+        literals = required_literals (pattern, flags)
+
+        def rmatch (i):
+            if i is None:
+                return False
+            return comp.search (i) is not None
+
+    db.create_function ('rmatch', 1, rmatch)
+    test = '(' + ' OR '.join ('rmatch(p.%s)' % f for f in fields) + ') '
+
+    # The trigram index can't find strings shorter than a trigram.
+    substrings = ['"' + l[0].replace ('"', '""') + '"' for l in literals
+                  if len (l[0]) >= 3]
+    if len (substrings) and db.has_index ('pubs_trigram'):
+        return ftsquery ('pubs_trigram', 'AND ' + test, ' AND '.join (substrings))
+
+    phrases = [p for p in (_literal_phrase (*l) for l in literals)
+               if p is not None]
+    if len (phrases) and have_words:
+        return ftsquery ('pubs_fts', 'AND ' + test, ' AND '.join (phrases))
+
+    # Nothing to go on; we have to check everything.
+    return db.pub_fquery ('SELECT ' + columns + ' FROM pubs AS p WHERE ' + test)
@@ -0,0 +1,131 @@
+# -*- mode: python; coding: utf-8 -*-
+# Copyright 2015 Peter Williams <peter@newton.cx>
+# Licensed under the GNU General Public License, version 3 or higher.
+
+"""
+Suggestions for mistyped publication identifiers.
+
+The "nfas_names" table holds each distinct first-author surname, and
+"nfas_trigram" indexes them by trigrams. To correct a surname, we pull out
+the names sharing the most trigrams with it, then rank those by edit
+distance. Only the first step touches the whole index, and it's a cheap
+one, so this stays fast with huge numbers of names. If the SQLite library
+can't maintain the trigram index, we compare against every name of about
+the right length instead.
+
+"""
+
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+from .util import *
+from .bibcore import classify_pub_ref
+
+__all__ = ('edit_distance suggest_nfas suggest_nfasy suggest_pub_refs').split ()
+
+
+def edit_distance (a, b, maxdist=None):
+    """The number of single-character insertions, deletions, substitutions,
+    and transpositions of adjacent characters needed to turn `a` into `b`. If
+    `maxdist` is given, we give up as soon as it's clear that the answer is
+    larger, and return `maxdist + 1`."""
+
+    prev2 = None
+    prev = range (len (b) + 1)
+
+    for i in xrange (1, len (a) + 1):
+        cur = [i] + [0] * len (b)
+
+        for j in xrange (1, len (b) + 1):
+            cost = 0 if a[i-1] == b[j-1] else 1
+            cur[j] = min (prev[j] + 1, cur[j-1] + 1, prev[j-1] + cost)
+
+            if (i > 1 and j > 1 and a[i-1] == b[j-2] and a[i-2] == b[j-1]):
+                cur[j] = min (cur[j], prev2[j-2] + 1)
+
+        if maxdist is not None and min (cur) > maxdist and min (prev) > maxdist:
+            # Every later row can only be worse. (We check two rows because
+            # a transposition can reach back across one.)
+            return maxdist + 1
+
+        prev2, prev = prev, cur
+
+    if maxdist is not None and prev[len (b)] > maxdist:
+        return maxdist + 1
+    return prev[len (b)]
+
+
+def suggest_nfas (db, nfas, ncandidates=100):
+    """Returns a list of (distance, npubs, name) for the known first-author
+    surnames that are close to `nfas`, best first. `nfas` should already be
+    normalized."""
+
+    maxdist = max (1, min (3, len (nfas) // 3))
+    candidates = {}
+
+    trigrams = set (nfas[i:i+3] for i in xrange (len (nfas) - 2))
+    if not db.has_index ('nfas_trigram'):
+        candidates.update (db.execute ('SELECT nfas, npubs FROM nfas_names WHERE '
+                                       'length(nfas) BETWEEN ? AND ?',
+                                       (len (nfas) - maxdist, len (nfas) + maxdist)))
+    elif len (trigrams):
+        query = ' OR '.join ('"%s"' % t.replace ('"', '""') for t in trigrams)
+        candidates.update (db.execute ('SELECT n.nfas, n.npubs FROM nfas_trigram AS t, '
+                                       'nfas_names AS n WHERE nfas_trigram MATCH ? AND '
+                                       'n.rowid == t.rowid ORDER BY bm25(nfas_trigram) '
+                                       'LIMIT ?', (query, ncandidates)))
+
+    # In a short name, one typo can break every trigram, so also try the
+    # names that start the same way.
+    if len (nfas) >= 2:
+        candidates.update (db.execute ('SELECT nfas, npubs FROM nfas_names WHERE '
+                                       'nfas >= ? AND nfas < ? AND '
+                                       'length(nfas) BETWEEN ? AND ? LIMIT ?',
+                                       (nfas[:2], nfas[:2] + '\x7f', len (nfas) - maxdist,
+                                        len (nfas) + maxdist, ncandidates)))
+
+    result = []
+
+    for name, npubs in candidates.iteritems ():
+        if abs (len (name) - len (nfas)) > maxdist:
+            continue
+
+        dist = edit_distance (nfas, name, maxdist)
+        if dist <= maxdist:
+            result.append ((dist, -npubs, name))
+
+    result.sort ()
+    return [(d, -n, name) for d, n, name in result]
+
+
+def suggest_nfasy (db, nfas, year=None, limit=5):
+    """Returns a list of up to `limit` existing "surname.year" identifiers that
+    are close to the given first-author surname and year, best first. If
+    `year` is None, the suggestions are of the form "surname.*"."""
+
+    result = []
+
+    for dist, npubs, name in suggest_nfas (db, nfas):
+        if year is None:
+            if name != nfas:
+                result.append ((dist, -npubs, name + '.*'))
+            continue
+
+        for (y, ) in db.execute ('SELECT DISTINCT year FROM pubs WHERE nfas == ? AND '
+                                 'year BETWEEN ? AND ?', (name, year - 1, year + 1)):
+            if name != nfas or y != year:
+                result.append ((dist + abs (y - year), -npubs, '%s.%d' % (name, y)))
+
+    result.sort ()
+    return [r[2] for r in result[:limit]]
+
+
+def suggest_pub_refs (db, textid, limit=5):
+    """Returns a list of identifiers that the user might have meant instead of
+    `textid`, best first. Only surname/year identifiers get suggestions."""
+
+    kind, text = classify_pub_ref (textid)
+    if kind != 'nfasy':
+        return []
+
+    nfas, year = text.rsplit ('.', 1)
+    return suggest_nfasy (db, nfas, None if year == '*' else int (year), limit)
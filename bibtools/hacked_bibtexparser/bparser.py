@@ -9,10 +9,11 @@
 
 import sys
 import logging
+import mmap
 
 logger = logging.getLogger(__name__)
 
-__all__ = ['BibTexParser']
+__all__ = ['BibTexParser', 'iter_records', 'iter_record_chunks', 'parse_record_chunk']
 
 
 if sys.version_info >= (3, 0):
@@ -43,17 +44,15 @@ class BibTexParser(object):
 
     """
     def __init__(self, fileobj, customization=None):
-        data = fileobj.read()
+        self._setup()
+        self.records = list(self._iter_records(fileobj, customization))
+        self.entries_hash = {}
 
+    def _setup(self):
         # On some sample data files, the character encoding detection simply hangs
         # We are going to default to utf8, and mandate it.
         self.encoding = 'utf8'
 
-        # Some files have Byte-order marks inserted at the start
-        if data[:3] == '\xef\xbb\xbf':
-            data = data[3:]
-        self.fileobj = StringIO(data)
-
         # set which bibjson schema this parser parses to
         self.has_metadata = False
         self.persons = []
@@ -72,9 +71,6 @@ class BibTexParser(object):
             'subjects': 'subject'
         }
 
-        self.records = self._parse_records(customization=customization)
-        self.entries_hash = {}
-
     def get_entry_list(self):
         """Get a list of bibtex entries.
 
@@ -94,50 +90,71 @@ class BibTexParser(object):
                 self.entries_hash[entry['id']] = entry
         return self.entries_hash
 
-    def _parse_records(self, customization=None):
-        """Parse the bibtex into a list of records.
+    def _iter_lines(self, fileobj):
+        """Yield the lines of `fileobj` as unicode, without any byte-order mark.
+        `fileobj` may be a file, an mmap, or any iterable of lines.
 
-        :param customization: a function
-        :returns: list -- records
+        As we go, `line_start` is the offset at which the current line starts
+        and `offset` the one at which it ends, in bytes if the lines are bytes.
         """
-        def _add_parsed_record(record, records):
-            """
-            Atomic function to parse a record
-            and append the result in records
-            """
-            if record != "":
-                logger.debug('The record is not empty. Let\'s parse it.')
-                parsed = self._parse_record(record, customization=customization)
-                if parsed:
-                    logger.debug('Store the result of the parsed record')
-                    records.append(parsed)
-                else:
-                    logger.debug('Nothing returned from the parsed record!')
-            else:
-                logger.debug('The record is empty')
-
-        records = []
-        record = ""
-        # read each line, bundle them up until they form an object, then send for parsing
-        for linenumber, line in enumerate(self.fileobj):
-            logger.debug('Inspect line %s', linenumber)
+        if isinstance(fileobj, mmap.mmap):
+            # mmaps iterate by byte, not by line.
+            lines = iter(fileobj.readline, b'')
+        else:
+            lines = iter(fileobj)
+
+        self.line_start = self.offset = 0
+        first = True
+        for line in lines:
+            self.line_start = self.offset
+            self.offset += len(line)
+            if not isinstance(line, ustr):
+                line = ustr(line, self.encoding, 'ignore')
+            if first:
+                # Some files have Byte-order marks inserted at the start
+                line = line.lstrip(u'\ufeff')
+                first = False
+            yield line
+
+    def _iter_record_texts(self, fileobj):
+        """Yield the unparsed text of each record in `fileobj`. When each is
+        yielded, `record_end` is the offset at which it ends, as by
+        _iter_lines().
+
+        :param fileobj: a file, mmap, or iterable of lines
+        :returns: generator -- strings
+        """
+        record = []
+        # read each line, bundle them up until they form an object
+        for line in self._iter_lines(fileobj):
             if '--BREAK--' in line:
-                logger.debug('--BREAK-- encountered')
+                self.offset = self.line_start
                 break
-            else:
-                if line.strip().startswith('@'):
-                    logger.debug('Line starts with @')
-                    _add_parsed_record(record, records)
-                    logger.debug('The record is set to empty')
-                    record = ""
-                if len(line.strip()) > 0:
-                    logger.debug('The line is not empty, add it to record')
-                    record += line
-
-        # catch any remaining record and send it for parsing
-        _add_parsed_record(record, records)
-        logger.debug('Return the result')
-        return records
+            stripped = line.strip()
+            if stripped.startswith('@'):
+                if record:
+                    self.record_end = self.line_start
+                    yield ''.join(record)
+                record = []
+            if stripped:
+                record.append(line)
+
+        # catch any remaining record
+        if record:
+            self.record_end = self.offset
+            yield ''.join(record)
+
+    def _iter_records(self, fileobj, customization=None):
+        """Parse the bibtex in `fileobj`, yielding the records one at a time.
+
+        :param fileobj: a file, mmap, or iterable of lines
+        :param customization: a function
+        :returns: generator -- records
+        """
+        for record in self._iter_record_texts(fileobj):
+            parsed = self._parse_record(record, customization=customization)
+            if parsed:
+                yield parsed
 
     def _parse_record(self, record, customization=None):
         """Parse a record.
@@ -154,7 +171,6 @@ class BibTexParser(object):
         d = {}
 
         if not record.startswith('@'):
-            logger.debug('The record does not start with @. Return empty dict.')
             return {}
 
         # prepare record
@@ -164,54 +180,40 @@ class BibTexParser(object):
 
         # if a string record, put it in the replace_dict
         if record.lower().startswith('@string'):
-            logger.debug('The record startswith @string')
             key, val = [i.strip().strip('"').strip('{').strip('}').replace('\n', ' ') for i in record.split('{', 1)[1].strip('\n').strip(',').strip('}').split('=')]
             self.replace_dict[key] = val
-            logger.debug('Return a dict')
             return d
 
         # for each line in record
-        logger.debug('Split the record of its lines and treat them')
         kvs = [i.strip() for i in record.split(',\n')]
         inkey = ""
         inval = ""
         for kv in kvs:
-            logger.debug('Inspect: %s', kv)
             if kv.startswith('@') and not inkey:
                 # it is the start of the record - set the bibtype and citekey (id)
-                logger.debug('Line starts with @ and the key is not stored yet.')
                 bibtype, id = kv.split('{', 1)
                 bibtype = self._add_key(bibtype)
                 id = id.strip('}').strip(',')
             elif '=' in kv and not inkey:
                 # it is a line with a key value pair on it
-                logger.debug('Line contains a key-pair value and the key is not stored yet.')
                 key, val = [i.strip() for i in kv.split('=', 1)]
                 key = self._add_key(key)
                 # if it looks like the value spans lines, store details for next loop
                 if (val.count('{') != val.count('}')) or (val.startswith('"') and not val.replace('}', '').endswith('"')):
-                    logger.debug('The line is not ending the record.')
                     inkey = key
                     inval = val
                 else:
-                    logger.debug('The line is the end of the record.')
                     d[key] = self._add_val(val)
             elif inkey:
-                logger.debug('Continues the previous line to complete the key pair value...')
                 # if this line continues the value from a previous line, append
                 inval += ', ' + kv
                 # if it looks like this line finishes the value, store it and clear for next loop
                 if (inval.startswith('{') and inval.endswith('}')) or (inval.startswith('"') and inval.endswith('"')):
-                    logger.debug('This line represents the end of the current key-pair value')
                     d[inkey] = self._add_val(inval)
                     inkey = ""
                     inval = ""
-                else:
-                    logger.debug('This line does NOT represent the end of the current key-pair value')
 
-        logger.debug('All lines have been treated')
         if not d:
-            logger.debug('The dict is empty, return it.')
             return d
 
         # put author names into persons list
@@ -226,11 +228,9 @@ class BibTexParser(object):
                 self.has_metadata = True
 
         if customization is None:
-            logger.debug('No customization to apply, return dict')
             return d
         else:
             # apply any customizations to the record object then return it
-            logger.debug('Apply customizations and return dict')
             return customization(d)
 
     def _strip_quotes(self, val):
@@ -266,9 +266,7 @@ class BibTexParser(object):
         """
         if not val:
             return ''
-        for k in list(self.replace_dict.keys()):
-            if val == k:
-                val = self.replace_dict[k]
+        val = self.replace_dict.get(val, val)
         if not isinstance(val, ustr):
             val = ustr(val, self.encoding, 'ignore')
 
@@ -297,9 +295,89 @@ class BibTexParser(object):
         :returns: string -- value
         """
         key = key.strip().strip('@').lower()
-        if key in list(self.alt_dict.keys()):
-            key = self.alt_dict[key]
+        key = self.alt_dict.get(key, key)
         if not isinstance(key, ustr):
             return ustr(key, 'utf-8')
         else:
             return key
+
+
+class _StreamParser(BibTexParser):
+    def __init__(self, fileobj, customization=None):
+        self._setup()
+        self.fileobj = fileobj
+        self.customization = customization
+
+    def __iter__(self):
+        return self._iter_records(self.fileobj, self.customization)
+
+
+def iter_records(fileobj, customization=None):
+    """Parse a bibtex file incrementally, yielding each record as soon as it
+    has been read. Unlike BibTexParser, the whole file is never held in
+    memory, so this is the thing to use for big files.
+
+    :param fileobj: a file (text or binary), mmap, or iterable of lines
+    :param customization: a function
+    :returns: generator -- records
+    """
+    return iter(_StreamParser(fileobj, customization))
+
+
+def iter_record_chunks(fileobj, chunksize=500, start=0):
+    """Split a bibtex file into chunks of unparsed records, to be parsed with
+    parse_record_chunk(), possibly in other processes. Finding where records
+    begin is much quicker than parsing them.
+
+    Each chunk is a tuple (strings, records, end), where `records` is a list
+    of up to `chunksize` record texts, `strings` is a dict of the @string
+    definitions that apply to them, and `end` is the offset in the file at
+    which the last of them ends, in bytes if the file gives bytes. @string
+    records are dealt with here, so they never appear in a chunk. Records
+    that end at or before the offset `start` are left out, apart from
+    @strings, so that an earlier pass over the file can be picked up where it
+    stopped.
+
+    :param fileobj: a file (text or binary), mmap, or iterable of lines
+    :param chunksize: an int
+    :param start: an int
+    :returns: generator -- chunks
+    """
+    parser = _StreamParser(fileobj)
+    records = []
+    end = start
+
+    for record in parser._iter_record_texts(fileobj):
+        if record[:7].lower() == '@string':
+            if records:
+                yield dict(parser.replace_dict), records, end
+                records = []
+            parser._parse_record(record)
+            continue
+
+        if parser.record_end <= start:
+            continue
+
+        records.append(record)
+        end = parser.record_end
+        if len(records) == chunksize:
+            yield dict(parser.replace_dict), records, end
+            records = []
+
+    if records:
+        yield dict(parser.replace_dict), records, end
+
+
+def parse_record_chunk(chunk, customization=None):
+    """Parse a chunk from iter_record_chunks(). There is one item in the result
+    for each record text in the chunk, which is empty if the text didn't
+    amount to a record, as with @comment.
+
+    :param chunk: a tuple
+    :param customization: a function
+    :returns: list -- records
+    """
+    strings, records = chunk[:2]
+    parser = _StreamParser(None, customization)
+    parser.replace_dict = strings
+    return [parser._parse_record(t, customization) for t in records]
@@ -0,0 +1,167 @@
+# -*- mode: python; coding: utf-8 -*-
+# Copyright 2015 Peter Williams <peter@newton.cx>
+# Licensed under the GNU General Public License, version 3 or higher.
+
+"""
+Structured searches of the local database.
+
+A search is a list of terms, all of which must match. Terms look like
+"key:value"; a bare integer is a year and any other bare word is an author
+surname. A term can be negated by prefixing it with "-". Each term compiles
+to a condition on an indexed column of the pubs table, or to a test of the
+pub ID against an indexed subquery, so that SQLite can start from whichever
+term is most selective.
+
+"""
+
+from __future__ import absolute_import, division, print_function, unicode_literals
+import re
+
+from .util import *
+from .bibcore import expand_year, normalize_surname
+
+__all__ = ('compile_search explain_search search_keys').split ()
+
+
+def _term_author (db, value):
+    return ('p.id IN (SELECT a.pubid FROM author_names AS n, authors AS a '
+            'WHERE n.surname == ? AND a.authid == n.oid)',
+            [normalize_surname (value)])
+
+
+def _parse_year (text):
+    try:
+        return expand_year (int (text))
+    except ValueError:
+        die ('bad year "%s" in search', text)
+
+
+def _term_year (db, value):
+    lo, sep, hi = value.partition ('-')
+
+    if not sep:
+        return 'p.year == ?', [_parse_year (lo)]
+    if not len (lo) and not len (hi):
+        die ('bad year range "%s" in search', value)
+    if not len (lo):
+        return 'p.year <= ?', [_parse_year (hi)]
+    if not len (hi):
+        return 'p.year >= ?', [_parse_year (lo)]
+    return 'p.year BETWEEN ? AND ?', [_parse_year (lo), _parse_year (hi)]
+
+
+def _has_words (text, words, _cache={}):
+    # Like an FTS phrase query, more or less: the words of `words`, in order,
+    # separated by anything that isn't a word.
+    regex = _cache.get (words)
+    if regex is None:
+        tokens = re.findall (r'\w+', words, re.UNICODE)
+        pattern = r'(?<!\w)' + r'\W+'.join (re.escape (t) for t in tokens) + r'(?!\w)'
+        regex = _cache[words] = re.compile (pattern, re.UNICODE | re.IGNORECASE)
+    return text is not None and regex.search (text) is not None
+
+
+def _term_title (db, value):
+    if db.has_index ('pubs_fts'):
+        return ('p.id IN (SELECT rowid FROM pubs_fts WHERE pubs_fts MATCH ?)',
+                ['title : "%s"' % value.replace ('"', '""')])
+
+    # Without the word index, we have to check every title.
+    db.create_function ('has_words', 2, _has_words)
+    return 'has_words(p.title, ?)', [value]
+
+
+def _term_pdf (db, value):
+    v = value.lower ()
+    if v in ('y', 'yes', '1', 'true'):
+        return 'p.id IN (SELECT pubid FROM pdfs)', []
+    if v in ('n', 'no', '0', 'false'):
+        return 'p.id NOT IN (SELECT pubid FROM pdfs)', []
+    die ('the "pdf" search term should be "yes" or "no"; got "%s"', value)
+
+
+_terms = {
+    'arxiv': lambda db, v: ('p.arxiv == ?', [v]),
+    'author': _term_author,
+    'bibcode': lambda db, v: ('p.bibcode == ?', [v]),
+    'doi': lambda db, v: ('p.doi == ?', [v]),
+    'group': lambda db, v: ('p.id IN (SELECT pubid FROM publists WHERE name == ?)',
+                            ['user_' + v]),
+    'issn': lambda db, v: ('p.id IN (SELECT pubid FROM refkeys WHERE issn == ?)', [v]),
+    'journal': lambda db, v: ('p.id IN (SELECT pubid FROM refkeys WHERE journal == ?)', [v]),
+    'nick': lambda db, v: ('p.id IN (SELECT pubid FROM nicknames WHERE nickname == ?)', [v]),
+    'pdf': _term_pdf,
+    'title': _term_title,
+    'year': _term_year,
+}
+
+_aliases = {
+    'au': 'author',
+}
+
+search_keys = sorted (_terms.keys () + _aliases.keys ())
+
+
+def compile_search (db, terms, columns='p.*'):
+    """Compile a list of search terms into SQL to run on `db`. Returns (sql,
+    args). `columns` is the list of columns to select from the pubs table,
+    which is aliased as "p"."""
+
+    conds = []
+    args = []
+
+    for term in terms:
+        if isinstance (term, bytes):
+            term = term.decode ('utf-8')
+
+        negate = term.startswith ('-') and len (term) > 1
+        if negate:
+            term = term[1:]
+
+        key, sep, value = term.partition (':')
+
+        if not sep:
+            if re.match (r'^\d+(-\d*)?$', term):
+                key, value = 'year', term
+            else:
+                key, value = 'author', term
+
+        key = _aliases.get (key.lower (), key.lower ())
+        if key not in _terms:
+            die ('unknown search term "%s:"; known ones are: %s', key,
+                 ', '.join (search_keys))
+        if not len (value):
+            die ('empty search term "%s:"', key)
+
+        cond, condargs = _terms[key] (db, value)
+        if negate:
+            cond = 'NOT (' + cond + ')'
+        conds.append (cond)
+        args += condargs
+
+    if not len (conds):
+        die ('no search terms given')
+
+    return ('SELECT ' + columns + ' FROM pubs AS p WHERE ' + ' AND '.join (conds),
+            args)
+
+
+def explain_search (db, sql, args):
+    """Returns (steps, scans), where `steps` is the query plan for `sql` as a list
+    of (depth, detail) tuples, and `scans` is a list of the tables that it
+    reads in full, rather than through an index."""
+
+    steps = []
+    scans = []
+    depths = {0: -1}
+
+    for id, parent, _, detail in db.execute ('EXPLAIN QUERY PLAN ' + sql, args):
+        depth = depths.get (parent, -1) + 1
+        depths[id] = depth
+        steps.append ((depth, detail))
+
+        m = re.match (r'^SCAN (\S+)', detail)
+        if m is not None and 'INDEX' not in detail:
+            scans.append (m.group (1))
+
+    return steps, scans
@@ -7,7 +7,6 @@ Import/export from our text format.
 """
 
 from __future__ import absolute_import, division, print_function, unicode_literals
-import json
 
 from .util import *
 from .bibcore import *
@@ -15,7 +14,13 @@ from .bibcore import *
 __all__ = ('export_one import_one').split ()
 
 
-def export_one (app, pub, stream, width):
+def export_one (app, pub, stream, width, authors=None):
+    """`authors` is this pub's entry in the result of
+    `app.db.get_authors_for_pubs()`; it's fetched if not provided."""
+
+    if authors is None:
+        authors = app.db.get_authors_for_pubs ((pub.id, ))[pub.id]
+
     write = stream.write
 
     # Title and year
@@ -49,14 +54,14 @@ def export_one (app, pub, stream, width):
 
     # Authors
     anyauth = False
-    for given, family in app.db.get_pub_authors (pub.id, 'author'):
+    for given, family in authors['author']:
         write (encode_name (given, family))
         write ('\n')
         anyauth = True
     if not anyauth:
         write ('--no authors--\n')
     firsteditor = True
-    for given, family in app.db.get_pub_authors (pub.id, 'editor'):
+    for given, family in authors['editor']:
         if firsteditor:
             write ('--editors--\n')
             firsteditor = False
@@ -68,7 +73,7 @@ def export_one (app, pub, stream, width):
     if pub.refdata is None:
         write ('--no reference data--\n')
     else:
-        rd = json.loads (pub.refdata)
+        rd = dict (pub.refdict)
 
         btype = rd.pop ('_type')
         write ('@')
@@ -337,17 +337,23 @@ def print_linewrapped (text, maxwidth=None, width=None, stream=None, rest_prefix
         write ('\n')
 
 
-def print_truncated (text, curofs, stream=None, color=None):
+def print_truncated (text, curofs, stream=None, color=None, width=None):
     """We assume that spaces within `text` are fungible.
 
     We take a `color` argument because otherwise we might truncate a "reset
     color" ANSI command!
 
+    If printing many lines, pass `width` so that we don't have to query the
+    terminal each time.
+
     """
     if stream is None:
         stream = sys.stdout
 
-    w = get_term_width (stream)
+    if width is None:
+        w = get_term_width (stream)
+    else:
+        w = width
     write = stream.write
 
     cc, reset = get_color_codes (stream, color, 'reset')
@@ -7,12 +7,12 @@ Various utilities for HTTP-related activities.
 """
 
 from __future__ import absolute_import, division, print_function, unicode_literals
-import codecs, cookielib, urllib, urllib2
+import codecs, cookielib, threading, urllib, urllib2
 
 from .util import *
 
-__all__ = ('HTMLParser HTTPError get_url_from_redirection parse_http_html '
-           'urlencode urljoin urlopen urlparse urlquote urlunparse urlunquote').split ()
+__all__ = ('HTMLParser HTTPError fetch_url get_url_from_redirection host_slot '
+           'parse_http_html urlencode urljoin urlopen urlparse urlquote urlunparse urlunquote').split ()
 
 
 urlencode = urllib.urlencode
@@ -29,6 +29,48 @@ except ImportError:
     from HTMLParser import HTMLParser
 
 
+# We may fetch from several threads at once, but shouldn't hammer any one
+# server while doing so.
+
+max_host_connections = 2
+_host_slots = {}
+_host_slots_lock = threading.Lock ()
+
+
+class host_slot (object):
+    """A context manager that waits until fewer than `max_host_connections`
+    threads are talking to the host of `url`, and holds one of the slots until
+    it exits."""
+
+    def __init__ (self, url):
+        host = urlparse (url).netloc.lower ()
+
+        with _host_slots_lock:
+            self.sem = _host_slots.get (host)
+            if self.sem is None:
+                self.sem = _host_slots[host] = threading.BoundedSemaphore (max_host_connections)
+
+    def __enter__ (self):
+        self.sem.acquire ()
+        return self
+
+    def __exit__ (self, etype, evalue, etb):
+        self.sem.release ()
+        return False
+
+
+def fetch_url (url):
+    """Returns the whole body of the response to `url` as bytes. Safe to call
+    from multiple threads."""
+
+    with host_slot (url):
+        resp = urlopen (url)
+        try:
+            return resp.read ()
+        finally:
+            resp.close ()
+
+
 class NonRedirectingProcessor (urllib2.HTTPErrorProcessor):
     # Copied from StackOverflow q 554446.
     def http_response (self, request, response):
@@ -0,0 +1,11 @@
+# -*- mode: python; coding: utf-8 -*-
+# Copyright 2015 Peter Williams <peter@newton.cx>
+# Licensed under the GNU General Public License, version 3 or higher.
+
+"""Tests of bibtools. Run them with "make test", or with
+
+  python -m unittest discover -s tests -t .
+
+from the top of the source tree.
+
+"""
@@ -0,0 +1,42 @@
+# -*- mode: python; coding: utf-8 -*-
+# Copyright 2015 Peter Williams <peter@newton.cx>
+# Licensed under the GNU General Public License, version 3 or higher.
+
+from __future__ import absolute_import, division, print_function, unicode_literals
+import unittest
+
+from bibtools.fulltext import _literal_phrase, required_literals
+
+
+class LiteralPhraseTests (unittest.TestCase):
+    def test_whole_tokens (self):
+        self.assertEqual (_literal_phrase ('magnetic flare', True, True), '"magnetic flare"')
+
+
+    def test_unanchored_leading_token_is_dropped (self):
+        # "magnetic" might be the end of "electromagnetic", so it can't be
+        # looked up as a token.
+        self.assertEqual (_literal_phrase ('magnetic flares', False, True), '"flares"')
+        self.assertEqual (_literal_phrase ('magnetic', False, True), None)
+
+
+    def test_separator_anchors_leading_token (self):
+        self.assertEqual (_literal_phrase (' magnetic flares', False, True),
+                          '"magnetic flares"')
+
+
+    def test_unanchored_trailing_token_is_prefix (self):
+        self.assertEqual (_literal_phrase ('a magnetic fla', False, False), '"magnetic fla"*')
+        self.assertEqual (_literal_phrase ('a magnetic fl', False, False), '"magnetic"')
+
+
+    def test_regex_without_whole_words (self):
+        # Neither literal is delimited, so there's nothing for the word index
+        # to look up.
+        lits = required_literals ('magnet.*flare')
+        self.assertEqual (lits, [('magnet', False, False), ('flare', False, False)])
+        self.assertEqual ([_literal_phrase (*l) for l in lits], [None, None])
+
+
+if __name__ == '__main__':
+    unittest.main ()
@@ -0,0 +1,70 @@
+# -*- mode: python; coding: utf-8 -*-
+# Copyright 2015 Peter Williams <peter@newton.cx>
+# Licensed under the GNU General Public License, version 3 or higher.
+
+from __future__ import absolute_import, division, print_function, unicode_literals
+import io, os.path, shutil, tempfile, unittest
+
+from bibtools import BibApp
+from bibtools.bibtex import import_stream
+from bibtools.config import BibConfig
+from bibtools.db import connect
+
+
+def bibtex (*records):
+    return b''.join (b'@ARTICLE{%s,\n  author = {{Smith}, A.},\n  title = "{%s}",\n'
+                     b'  year = 1990,\n  doi = {%s}\n}\n\n' % r for r in records)
+
+
+class MergeTests (unittest.TestCase):
+    def setUp (self):
+        self.workdir = tempfile.mkdtemp (prefix='bibtest.')
+        self.app = BibApp ()
+        self.app._thedb = connect (BibConfig (), os.path.join (self.workdir, 'db.sqlite3'),
+                                   create=True)
+        self.ingest (bibtex ((b'one', b'Original', b'10.1000/a')))
+
+
+    def tearDown (self):
+        self.app.db.close ()
+        shutil.rmtree (self.workdir)
+
+
+    def ingest (self, text, **kwargs):
+        return import_stream (self.app, io.BytesIO (text), **kwargs)
+
+
+    def title (self):
+        return self.app.db.getfirstval ('SELECT title FROM pubs')
+
+
+    # Two records that both match the pub by DOI.
+    dups = bibtex ((b'one', b'First', b'10.1000/a'), (b'two', b'Second', b'10.1000/a'))
+
+    def test_same_pub_skipped (self):
+        counts = self.ingest (self.dups, merge=True, conflicts='skip')
+        self.assertEqual ((counts['changed'], counts['ambiguous']), (1, 1))
+        self.assertEqual (self.title (), 'First')
+
+        # Again, without the pub flipping between the records.
+        counts = self.ingest (self.dups, merge=True, conflicts='skip')
+        self.assertEqual ((counts['changed'], counts['unchanged'], counts['ambiguous']),
+                          (0, 1, 1))
+        self.assertEqual (self.title (), 'First')
+
+
+    def test_same_pub_across_batches (self):
+        self.app.db.learn_batch_size = 1
+        counts = self.ingest (self.dups, merge=True, conflicts='rename')
+        self.assertEqual ((counts['changed'], counts['ambiguous']), (1, 1))
+        self.assertEqual (self.title (), 'First')
+
+
+    def test_same_pub_fails (self):
+        with self.assertRaises (SystemExit):
+            self.ingest (self.dups, merge=True)
+        self.assertEqual (self.title (), 'Original')
+
+
+if __name__ == '__main__':
+    unittest.main ()
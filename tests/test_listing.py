@@ -0,0 +1,65 @@
+# -*- mode: python; coding: utf-8 -*-
+# Copyright 2015 Peter Williams <peter@newton.cx>
+# Licensed under the GNU General Public License, version 3 or higher.
+
+from __future__ import absolute_import, division, print_function, unicode_literals
+import io, os.path, shutil, tempfile, unittest
+
+from bibtools import BibApp
+from bibtools.bibcore import print_streaming_listing
+from bibtools.config import BibConfig
+from bibtools.db import connect
+
+
+def make_info (i):
+    return dict (authors=['A. Smith%d' % i],
+                 nicknames=['pub%d' % i],
+                 refdata={'_type': 'article'},
+                 title='Title %d' % i,
+                 year=1900 + i % 100)
+
+
+class StreamingListingTests (unittest.TestCase):
+    npubs = 701
+
+    def setUp (self):
+        self.workdir = tempfile.mkdtemp (prefix='bibtest.')
+        self.app = BibApp ()
+        self.app._thedb = connect (BibConfig (), os.path.join (self.workdir, 'db.sqlite3'),
+                                   create=True)
+        self.app.db.learn_pubs (make_info (i) for i in xrange (self.npubs))
+
+
+    def tearDown (self):
+        self.app.db.close ()
+        shutil.rmtree (self.workdir)
+
+
+    def listing (self, textids, **kwargs):
+        db = self.app.db
+        refs = [self.app.parse_pub_ref (t) for t in textids]
+        stream = io.StringIO ()
+        print_streaming_listing (db, db.pub_refs_query (refs, db.listing_columns),
+                                 stream=stream, **kwargs)
+        return [l.split ()[2] for l in stream.getvalue ().splitlines ()]
+
+
+    def test_many_refs (self):
+        # More refs than SQLite allows terms in a compound SELECT.
+        textids = ['pub%d' % i for i in reversed (xrange (self.npubs))]
+        self.assertEqual (self.listing (textids, sort='none'), textids)
+
+
+    def test_paging (self):
+        textids = ['pub%d' % i for i in xrange (self.npubs)]
+        self.assertEqual (self.listing (textids, sort='none', limit=3, offset=600),
+                          ['pub600', 'pub601', 'pub602'])
+
+
+    def test_duplicates_listed_once (self):
+        textids = ['pub%d' % (i % 550) for i in xrange (self.npubs)]
+        self.assertEqual (self.listing (textids, sort='none'), textids[:550])
+
+
+if __name__ == '__main__':
+    unittest.main ()